@@ -1,21 +1,78 @@
+import zlib
 import zipfile
 from pathlib import Path
 from io import IOBase
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
-def unload_zip_from_io(buf: IOBase, export_folder):
+
+def _file_crc32(path, chunk_size=1024*1024):
+  crc = 0
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      crc = zlib.crc32(chunk, crc)
+  return crc
+
+def _is_extracted(member, target):
+  if not target.is_file() or target.stat().st_size != member.file_size:
+    return False
+  return _file_crc32(target) == member.CRC
+
+def select_zip_members(zp: zipfile.ZipFile, filenames=None):
+  """Members matching `filenames`, by full name or base name, all files if None."""
+  members = [m for m in zp.infolist() if not m.is_dir()]
+  if filenames is None:
+    return members
+  filenames = set(filenames)
+  return [m for m in members if m.filename in filenames or Path(m.filename).name in filenames]
+
+def unload_zip_from_io(buf: IOBase, export_folder, members=None, workers=None):
+  """Extract a zip archive, or only the `members` a loader needs.
+
+  Members already on disk with the same size and CRC are skipped, the
+  others are decompressed in parallel (zlib releases the GIL, the shared
+  archive handle is locked per read by zipfile).
+
+  Args:
+      members[optional]: file names or base names to extract, e.g. the
+        'filename' entries of a loader's data_dir
+      workers[optional]: number of extraction threads
+  """
   export_folder = Path(export_folder)
 
   with zipfile.ZipFile(buf) as zp:
+    selected = select_zip_members(zp, members)
+    if members is not None:
+      missing = set(members) - {m.filename for m in selected} - {Path(m.filename).name for m in selected}
+      if missing:
+        raise ValueError(f'members not found in archive: {sorted(missing)}')
+
+    pending = [m for m in selected if not _is_extracted(m, export_folder / m.filename)]
+    print(f'extracting zip file content: {len(pending)} of {len(selected)} members')
+    for member in pending:
+      print('extracting',
+        f'size: {member.file_size}',
+        f'filename: {member.filename}',
+        sep=' - '
+      )
+    # zipfile creates parent folders without exist_ok, so concurrent
+    # members of one folder would race on it
+    for folder in {(export_folder / m.filename).parent for m in pending}:
+      folder.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      list(executor.map(lambda m: zp.extract(m, path=export_folder), pending))
+
+@contextmanager
+def open_zip_member(archive, filename):
+  """Read one member straight from the archive as a binary stream, no extraction.
 
-    print('extracting zip file content:')
-    for member in zp.infolist():
-      extract_tgt = export_folder / member.filename
-      if extract_tgt.exists():
-        print(f'file already exists: {extract_tgt}')
-      else:
-        print('extracting',
-          f'size: {member.file_size}',
-          f'filename: {member.filename}',
-          sep=' - '
-        )      
-        zp.extract(member, path=export_folder)
\ No newline at end of file
+  Args:
+      archive: path or file object of the zip archive
+      filename: member name or base name
+  """
+  with zipfile.ZipFile(archive) as zp:
+    selected = select_zip_members(zp, [filename])
+    if not selected:
+      raise ValueError(f'{filename} not found in archive')
+    with zp.open(selected[0]) as fp:
+      yield fp
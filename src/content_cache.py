@@ -0,0 +1,356 @@
+from collections import OrderedDict
+from heapq import heappush, heappop, heapify
+
+_MISSING = object()
+
+
+class CachePolicy:
+  """Eviction policy interface.
+
+  Policies only track keys (and sizes where needed), the owning
+  ContentCache keeps the entries and the byte counter. Every method
+  is expected to run in O(1) (amortized O(log n) for heap based ones).
+  """
+  name = None
+
+  def on_insert(self, key, size):
+    raise NotImplementedError
+
+  def on_hit(self, key):
+    raise NotImplementedError
+
+  def on_remove(self, key):
+    raise NotImplementedError
+
+  def pop_victim(self):
+    raise NotImplementedError
+
+  def clear(self):
+    raise NotImplementedError
+
+
+class LRUPolicy(CachePolicy):
+  name = 'lru'
+
+  def __init__(self):
+    self._order = OrderedDict()
+
+  def on_insert(self, key, size):
+    self._order[key] = None
+
+  def on_hit(self, key):
+    self._order.move_to_end(key)
+
+  def on_remove(self, key):
+    del self._order[key]
+
+  def pop_victim(self):
+    key, _ = self._order.popitem(last=False)
+    return key
+
+  def clear(self):
+    self._order.clear()
+
+
+class FIFOPolicy(LRUPolicy):
+  name = 'fifo'
+
+  def on_hit(self, key):
+    pass
+
+
+class LFUPolicy(CachePolicy):
+  """Least frequently used, ties broken by least recently used.
+
+  Keys are kept in per-frequency ordered buckets so that hits and
+  evictions never scan the whole cache.
+  """
+  name = 'lfu'
+
+  def __init__(self):
+    self._freq = {}
+    self._buckets = {}
+    self._min_freq = 0
+
+  def on_insert(self, key, size):
+    self._freq[key] = 1
+    self._buckets.setdefault(1, OrderedDict())[key] = None
+    self._min_freq = 1
+
+  def on_hit(self, key):
+    freq = self._freq[key]
+    self._unlink(key, freq)
+    if self._min_freq == freq and freq not in self._buckets:
+      self._min_freq = freq + 1
+    self._freq[key] = freq + 1
+    self._buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+  def on_remove(self, key):
+    freq = self._freq.pop(key)
+    self._unlink(key, freq)
+    if self._min_freq == freq and freq not in self._buckets:
+      self._min_freq = min(self._buckets) if self._buckets else 0
+
+  def pop_victim(self):
+    key = next(iter(self._buckets[self._min_freq]))
+    self.on_remove(key)
+    return key
+
+  def _unlink(self, key, freq):
+    bucket = self._buckets[freq]
+    del bucket[key]
+    if not bucket:
+      del self._buckets[freq]
+
+  def clear(self):
+    self._freq.clear()
+    self._buckets.clear()
+    self._min_freq = 0
+
+
+class GDSFPolicy(CachePolicy):
+  """Greedy-Dual-Size-Frequency.
+
+  priority = clock + frequency * cost / size, where clock is inflated to
+  the priority of the last evicted key. Small, popular objects stay
+  longer than large ones. Stale heap records are skipped lazily and the
+  heap is compacted once they outnumber the live ones.
+  """
+  name = 'gdsf'
+
+  def __init__(self, cost=1.):
+    self.cost = cost
+    self.clock = 0.
+    self._heap = []
+    self._records = {}
+    self._seq = 0
+
+  def _push(self, key, freq, size):
+    priority = self.clock + freq * self.cost / (size if size > 0 else 1)
+    self._seq += 1
+    record = [priority, self._seq, key, freq, size]
+    self._records[key] = record
+    heappush(self._heap, record)
+    if len(self._heap) > 2 * len(self._records) + 64:
+      self._heap = list(self._records.values())
+      heapify(self._heap)
+
+  def on_insert(self, key, size):
+    self._push(key, 1, size)
+
+  def on_hit(self, key):
+    _, _, _, freq, size = self._records[key]
+    self._push(key, freq + 1, size)
+
+  def on_remove(self, key):
+    del self._records[key]
+
+  def pop_victim(self):
+    while True:
+      record = heappop(self._heap)
+      if self._records.get(record[2]) is record:
+        break
+    del self._records[record[2]]
+    self.clock = record[0]
+    return record[2]
+
+  def clear(self):
+    self.clock = 0.
+    self._heap.clear()
+    self._records.clear()
+
+
+CACHE_POLICIES = {
+  LRUPolicy.name: LRUPolicy,
+  FIFOPolicy.name: FIFOPolicy,
+  LFUPolicy.name: LFUPolicy,
+  GDSFPolicy.name: GDSFPolicy,
+}
+
+
+def get_policy(policy):
+  if isinstance(policy, CachePolicy):
+    return policy
+  if isinstance(policy, type) and issubclass(policy, CachePolicy):
+    return policy()
+  if isinstance(policy, str) and policy.lower() in CACHE_POLICIES:
+    return CACHE_POLICIES[policy.lower()]()
+  raise ValueError(f'unknown cache policy: {policy}')
+
+
+class ContentCache:
+  """Size-aware content cache with pluggable eviction.
+
+  Entries are indexed by id in a dict, the policy keeps its own ordered
+  structure, and the byte counter `used` is updated on every insert and
+  removal, so hits, misses and evictions never rescan the cache.
+
+  Eviction follows the watermark scheme used by the emulator tasks: once
+  `used` exceeds `alloc * high_watermark`, entries are evicted until
+  `used <= alloc * low_watermark`.
+
+  Args:
+      alloc: capacity, in the same unit as entry sizes (bytes)
+      policy: 'lru', 'fifo', 'lfu', 'gdsf', or a CachePolicy instance/class
+      high_watermark: fraction of alloc that triggers eviction
+      low_watermark: fraction of alloc to evict down to, defaults to
+        high_watermark
+      size_fn: callable returning an entry size when put() is called
+        without one, defaults to entry['sizeof'] when available, else 1
+  """
+
+  def __init__(self, alloc, policy='lru', high_watermark=1., low_watermark=None, size_fn=None):
+    self.alloc = alloc
+    self.policy = get_policy(policy)
+    self.high_watermark = high_watermark
+    self.low_watermark = high_watermark if low_watermark is None else low_watermark
+    self.size_fn = size_fn
+    self.used = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._entries = {}
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, key):
+    return key in self._entries
+
+  def __iter__(self):
+    return iter(self._entries)
+
+  def _sizeof(self, entry):
+    if self.size_fn is not None:
+      return self.size_fn(entry)
+    try:
+      return entry['sizeof']
+    except (TypeError, KeyError, IndexError):
+      return 1
+
+  def get(self, key, default=None):
+    item = self._entries.get(key, _MISSING)
+    if item is _MISSING:
+      self.misses += 1
+      return default
+    self.hits += 1
+    self.policy.on_hit(key)
+    return item[0]
+
+  def peek(self, key, default=None):
+    item = self._entries.get(key, _MISSING)
+    return default if item is _MISSING else item[0]
+
+  def put(self, key, entry=None, size=None):
+    """Insert or refresh an entry, returns the list of evicted keys."""
+    if size is None:
+      size = self._sizeof(entry)
+    item = self._entries.get(key, _MISSING)
+    if item is _MISSING:
+      self.policy.on_insert(key, size)
+    else:
+      self.used -= item[1]
+      self.policy.on_hit(key)
+    self._entries[key] = (entry, size)
+    self.used += size
+
+    if self.used > self.alloc * self.high_watermark:
+      return self.shrink(self.alloc * self.low_watermark)
+    return []
+
+  def access(self, key, entry=None, size=None):
+    """Request `key`, inserting it on a miss. Returns True on a hit."""
+    if key in self._entries:
+      self.hits += 1
+      self.policy.on_hit(key)
+      return True
+    self.misses += 1
+    self.put(key, entry, size)
+    return False
+
+  def access_many(self, keys, sizes):
+    """Vector form of access() for trace replay, returns a list of hit flags."""
+    if type(self.policy) in (LRUPolicy, FIFOPolicy):
+      hits = self._access_many_ordered(keys, sizes)
+    else:
+      entries = self._entries
+      on_hit = self.policy.on_hit
+      put = self.put
+      hits = []
+      append = hits.append
+      for key, size in zip(keys, sizes):
+        if key in entries:
+          on_hit(key)
+          append(True)
+        else:
+          put(key, None, size)
+          append(False)
+    n_hits = sum(hits)
+    self.hits += n_hits
+    self.misses += len(hits) - n_hits
+    return hits
+
+  def _access_many_ordered(self, keys, sizes):
+    # inlined LRU/FIFO loop, same semantics as put() and shrink()
+    entries = self._entries
+    order = self.policy._order
+    popitem = order.popitem
+    move_to_end = order.move_to_end if type(self.policy) is LRUPolicy else None
+    high = self.alloc * self.high_watermark
+    low = self.alloc * self.low_watermark
+    used = self.used
+    evictions = 0
+    hits = []
+    append = hits.append
+    for key, size in zip(keys, sizes):
+      if key in entries:
+        if move_to_end is not None:
+          move_to_end(key)
+        append(True)
+        continue
+      entries[key] = (None, size)
+      order[key] = None
+      used += size
+      if used > high:
+        while used > low and entries:
+          victim, _ = popitem(last=False)
+          used -= entries.pop(victim)[1]
+          evictions += 1
+      append(False)
+    self.used = used
+    self.evictions += evictions
+    return hits
+
+  def pop(self, key, default=None):
+    item = self._entries.pop(key, _MISSING)
+    if item is _MISSING:
+      return default
+    self.policy.on_remove(key)
+    self.used -= item[1]
+    return item[0]
+
+  def evict(self):
+    key = self.policy.pop_victim()
+    _, size = self._entries.pop(key)
+    self.used -= size
+    self.evictions += 1
+    return key
+
+  def shrink(self, target):
+    evicted = []
+    while self.used > target and self._entries:
+      evicted.append(self.evict())
+    return evicted
+
+  def clear(self):
+    self._entries.clear()
+    self.policy.clear()
+    self.used = 0
+
+  def reset_stats(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: {self.policy.name}  entries: {len(self)}  used: {self.used} / {self.alloc}>'
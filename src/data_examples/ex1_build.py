@@ -1,20 +1,38 @@
+import numpy as np
 import tensorflow as tf
 from src.tf_layer_constructors import (
-  gen_multihot_categorical_encoding_layer,
-  gen_normalization_layer
+  multihot_categorical_encoding_layer_from_stats,
+  normalization_layer_from_stats
 )
+from src.feature_stats import FeatureStats
 from src.tf_utils import MetricsLogger
 from src.utils import dict_to_flat_list
 from src.custom_types import TypeEnum
 from os.path import join as joinpath
 
-def generate_input_layers(tfds_train, data_loader):
+def generate_feature_stats(tfds_train, data_loader):
+  """Statistics of every input column in one pass over the dataset.
+
+  The result can be saved, reused across client models, or merged from
+  the clients' own statistics (FeatureStats.merge_all) in federated runs.
+  """
+  return FeatureStats.from_dataset(
+    tfds_train,
+    data_loader.features_numeric_continuous,
+    data_loader.features_categorical
+  )
+
+def generate_input_layers(tfds_train, data_loader, stats=None):
   """Generate input layers based on customized data_loader attributes.
 
   Args:
       tfds_train: TensorFlow Dataset for training
       data_loader: data loader class instance 
+      stats[optional]: precomputed FeatureStats, computed from
+        tfds_train in a single pass when not given
   """
+  if stats is None:
+    stats = generate_feature_stats(tfds_train, data_loader)
 
   # layers are stored in dictionary for verbosity, traceability, 
   # and debugging purposes
@@ -33,7 +51,7 @@ def generate_input_layers(tfds_train, data_loader):
   for col_name in data_loader.features_numeric_continuous:
 
     input_numeric = tf.keras.Input(shape=(1,), name=col_name, dtype='float32')
-    normalization_layer = gen_normalization_layer(tfds_train, col_name)
+    normalization_layer = normalization_layer_from_stats(stats, col_name)
     encoded_normalized_input = normalization_layer(input_numeric)
 
     all_inputs['normalization'][col_name] = input_numeric
@@ -49,7 +67,7 @@ def generate_input_layers(tfds_train, data_loader):
 
   for col_name in data_loader.features_categorical:
     input_categorical = tf.keras.Input(shape=(1,), name=col_name, dtype='string')
-    categorical_encoder = gen_multihot_categorical_encoding_layer(tfds_train, col_name, TypeEnum.string)
+    categorical_encoder = multihot_categorical_encoding_layer_from_stats(stats, col_name, TypeEnum.string)
     encoded_categorical_input = categorical_encoder(input_categorical)
 
     all_inputs['categorical'][col_name] = input_categorical
@@ -57,7 +75,7 @@ def generate_input_layers(tfds_train, data_loader):
 
   return all_inputs, all_encoded_features
 
-def build_input_layers(tfds, data_loader):
+def build_input_layers(tfds, data_loader, stats=None):
   """Generator for input layers.
 
   Input layers constructed from generate_input_layers() yields 
@@ -68,15 +86,16 @@ def build_input_layers(tfds, data_loader):
   Args:
       tfds_train: TensorFlow Dataset for training
       data_loader: data loader class instance 
+      stats[optional]: precomputed FeatureStats
   """
-  input_layers, encoded_layers = generate_input_layers(tfds, data_loader)
+  input_layers, encoded_layers = generate_input_layers(tfds, data_loader, stats)
   input_layers = dict_to_flat_list(input_layers, ls=[])
   encoded_layers = dict_to_flat_list(encoded_layers, ls=[])
   feature_layers = tf.keras.layers.concatenate(encoded_layers)
 
   return input_layers, feature_layers
 
-def build_model(tfds, data_loader, name='model', activation='sigmoid'):
+def build_model(tfds, data_loader, name='model', activation='sigmoid', stats=None):
   """Generator for the model.
 
   Customize this generator for other types of algorithm
@@ -90,8 +109,9 @@ def build_model(tfds, data_loader, name='model', activation='sigmoid'):
       activation[optional]: the activation function to 
       pass through. Defaults to `sigmoid` for logistic
       regression
+      stats[optional]: precomputed FeatureStats
   """
-  input_layers, feature_layers = build_input_layers(tfds, data_loader)
+  input_layers, feature_layers = build_input_layers(tfds, data_loader, stats)
 
   x = tf.keras.layers.Dense(32, activation=activation)(feature_layers)
   x = tf.keras.layers.Dropout(0.5)(x)
@@ -111,6 +131,274 @@ def compile_model(
   return model
 
 
+def _fresh(obj):
+  # new instance of a stateful keras object (optimizer, metric), names pass through
+  if isinstance(obj, str):
+    return obj
+  return obj.__class__.from_config(obj.get_config())
+
+
+class ModelTemplate:
+  """Builds and compiles the architecture once, then hands out models.
+
+  Two ways to get a client model without rebuilding the graph or
+  re-adapting the preprocessing layers:
+
+  - new_model(): a clone of the template with fresh optimizer and metric
+    instances, compiled and loaded with the given (or initial) weights
+  - reset(): swaps weights into the single reused template instance and
+    clears its optimizer state, so Keras keeps its traced train function;
+    meant for one instance per worker training clients one after another
+
+  train_step() returns a tf.function over the reused instance that is
+  traced once and shared by every client fitted through fit().
+
+  Args:
+      tfds: training dataset, only read when `stats` is not given
+      data_loader: data loader class instance
+      stats[optional]: precomputed FeatureStats
+  """
+  def __init__(
+      self,
+      tfds,
+      data_loader,
+      stats=None,
+      name='model',
+      activation='sigmoid',
+      optimizer='adam',
+      loss=tf.keras.losses.BinaryCrossentropy(),
+      metrics=['accuracy', 'mse']
+    ):
+    self.optimizer = optimizer
+    self.loss = loss
+    self.metrics = metrics
+    self.model = build_model(tfds, data_loader, name=name, activation=activation, stats=stats)
+    compile_model(self.model, optimizer=_fresh(optimizer), loss=loss, metrics=[_fresh(m) for m in metrics])
+    self.initial_weights = self.model.get_weights()
+    self._train_step = None
+
+  def new_model(self, name=None, weights=None, metrics=None):
+    model = tf.keras.models.clone_model(self.model)
+    if name is not None:
+      model.name = name
+    metrics = self.metrics if metrics is None else metrics
+    compile_model(model, optimizer=_fresh(self.optimizer), loss=self.loss, metrics=[_fresh(m) for m in metrics])
+    model.set_weights(self.initial_weights if weights is None else weights)
+    return model
+
+  def reset(self, weights=None):
+    self.model.set_weights(self.initial_weights if weights is None else weights)
+    for var in self.model.optimizer.variables:
+      # iteration count and slots, the learning rate is an optimizer variable too
+      if var.name != 'learning_rate':
+        var.assign(tf.zeros_like(var))
+    for metric in self.model.metrics:
+      metric.reset_state()
+    return self.model
+
+  def train_step(self):
+    if self._train_step is None:
+      model = self.model
+      optimizer = model.optimizer
+      loss_fn = tf.keras.losses.get(self.loss) if isinstance(self.loss, str) else self.loss
+      optimizer.build(model.trainable_variables)
+
+      @tf.function(reduce_retracing=True)
+      def train_step(x, y):
+        with tf.GradientTape() as tape:
+          y_pred = model(x, training=True)
+          loss = loss_fn(y, y_pred)
+          if model.losses:
+            loss += tf.add_n(model.losses)
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+        return loss
+
+      self._train_step = train_step
+    return self._train_step
+
+  def fit(self, tfds, weights=None, epochs=1):
+    """Train the reused instance from `weights` with the shared train step.
+
+    Returns:
+        (weights, mean loss of the last epoch)
+    """
+    self.reset(weights)
+    train_step = self.train_step()
+    total, n = 0., 0
+    for _ in range(epochs):
+      total, n = 0., 0
+      for x, y in tfds:
+        total += float(train_step(x, y))
+        n += 1
+    return self.model.get_weights(), total / max(n, 1)
+
+
+class StackedTrainer:
+  """Trains N replicas of a ModelTemplate's dense head as one computation.
+
+  The preprocessing part of the model has no trainable weights, so it is
+  shared and run once over the batches of all clients together. The
+  Dense/Dropout head is replicated with its weights stacked along a
+  leading client axis and applied with batched matmuls, so a single
+  step advances every client. Clients keep their own optimizer state and
+  step count, clients whose data ran out for the epoch are masked, and
+  losses and metrics are kept per client.
+
+  Supports the 'adam' and 'sgd' optimizers of the template.
+  """
+  def __init__(self, template: ModelTemplate, n_clients, seed=None):
+    self.template = template
+    self.n_clients = n_clients
+    model = template.model
+    head = [l for l in model.layers if isinstance(l, (tf.keras.layers.Dense, tf.keras.layers.Dropout))]
+    self.feature_model = tf.keras.Model(model.inputs, head[0].input)
+    self.head = [
+      ('dense', layer.activation) if isinstance(layer, tf.keras.layers.Dense) else ('dropout', layer.rate)
+      for layer in head
+    ]
+    head_paths = [v.path for l in head for v in l.weights]
+    self._head_index = [i for i, v in enumerate(model.weights) if v.path in head_paths]
+
+    optimizer = _fresh(template.optimizer)
+    if isinstance(optimizer, str):
+      optimizer = tf.keras.optimizers.get(optimizer)
+    if not isinstance(optimizer, (tf.keras.optimizers.Adam, tf.keras.optimizers.SGD)) or \
+        (isinstance(optimizer, tf.keras.optimizers.SGD) and optimizer.momentum):
+      raise ValueError(f'stacked training supports adam and plain sgd, got {optimizer.__class__.__name__}')
+    self.optimizer_cfg = optimizer.get_config()
+    self.adam = isinstance(optimizer, tf.keras.optimizers.Adam)
+
+    loss_cfg = dict(template.loss.get_config(), reduction=None)
+    self.loss_fn = template.loss.__class__.from_config(loss_cfg)
+    self._rng = tf.random.Generator.from_seed(seed) if seed is not None else tf.random.Generator.from_non_deterministic_state()
+
+    head_weights = [model.get_weights()[i] for i in self._head_index]
+    self.params = [tf.Variable(np.stack([w] * n_clients)) for w in head_weights]
+    self._m = [tf.Variable(tf.zeros_like(p)) for p in self.params]
+    self._v = [tf.Variable(tf.zeros_like(p)) for p in self.params]
+    self._t = tf.Variable(tf.zeros(n_clients, dtype=tf.float32))
+    self._step = tf.function(self._train_step, reduce_retracing=True)
+
+  def set_weights(self, weights_ls):
+    """Load one full model weight list (model.get_weights() order) per client."""
+    for j, i in enumerate(self._head_index):
+      self.params[j].assign(np.stack([w[i] for w in weights_ls]))
+    for var in self._m + self._v + [self._t]:
+      var.assign(tf.zeros_like(var))
+
+  def get_weights(self):
+    """Full model weight list per client, ready for set_weights() or aggregation."""
+    base = self.template.model.get_weights()
+    stacked = [p.numpy() for p in self.params]
+    out = []
+    for c in range(self.n_clients):
+      weights = list(base)
+      for j, i in enumerate(self._head_index):
+        weights[i] = stacked[j][c]
+      out.append(weights)
+    return out
+
+  def _forward(self, feats, training):
+    h, k = feats, 0
+    for kind, arg in self.head:
+      if kind == 'dense':
+        h = arg(tf.einsum('nbf,nfh->nbh', h, self.params[k]) + self.params[k + 1][:, None, :])
+        k += 2
+      elif training and arg > 0:
+        h = h * tf.cast(self._rng.uniform(tf.shape(h)) >= arg, h.dtype) / (1. - arg)
+    return h
+
+  def _train_step(self, feats, y, mask, active):
+    with tf.GradientTape() as tape:
+      y_pred = self._forward(feats, training=True)
+      y = tf.reshape(y, tf.shape(y_pred))
+      per_sample = self.loss_fn(y, y_pred)
+      per_client = tf.reduce_sum(per_sample * mask, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1.)
+      total = tf.reduce_sum(per_client)
+    grads = tape.gradient(total, self.params)
+
+    cfg = self.optimizer_cfg
+    lr = tf.cast(cfg['learning_rate'], tf.float32)
+    self._t.assign_add(active)
+    for p, g, m, v in zip(self.params, grads, self._m, self._v):
+      act = tf.reshape(active, [-1] + [1] * (len(p.shape) - 1))
+      if self.adam:
+        t = tf.reshape(self._t, tf.shape(act))
+        m_new = cfg['beta_1'] * m + (1 - cfg['beta_1']) * g
+        v_new = cfg['beta_2'] * v + (1 - cfg['beta_2']) * tf.square(g)
+        alpha = lr * tf.sqrt(1 - tf.pow(cfg['beta_2'], t)) / (1 - tf.pow(cfg['beta_1'], t))
+        update = alpha * m_new / (tf.sqrt(v_new) + cfg['epsilon'])
+        m.assign(act * m_new + (1 - act) * m)
+        v.assign(act * v_new + (1 - act) * v)
+      else:
+        update = lr * g
+      p.assign_sub(act * update)
+    y_pred = tf.squeeze(y_pred, -1)
+    y = tf.squeeze(y, -1)
+    correct = tf.reduce_sum(tf.cast(tf.equal(y, tf.cast(y_pred > .5, y.dtype)), tf.float32) * mask, axis=1)
+    squared_error = tf.reduce_sum(tf.square(y - y_pred) * mask, axis=1)
+    return per_client, correct, squared_error
+
+  def fit(self, datasets, epochs=1):
+    """One stacked fit over per-client (features, labels) datasets.
+
+    Returns:
+        dict of per-client arrays over the last epoch: 'loss' (mean of the
+        batch losses, as Keras reports it), 'accuracy' and 'mse'
+    """
+    if len(datasets) != self.n_clients:
+      raise ValueError(f'expected {self.n_clients} datasets, got {len(datasets)}')
+    # N iterators advance in lockstep, an autotuning thread per iterator only
+    # competes with the step (and stalls releasing the iterators)
+    options = tf.data.Options()
+    options.autotune.enabled = False
+    datasets = [ds.with_options(options) for ds in datasets]
+    for _ in range(epochs):
+      iterators = [iter(ds) for ds in datasets]
+      loss_sum = np.zeros(self.n_clients)
+      steps = np.zeros(self.n_clients)
+      correct = np.zeros(self.n_clients)
+      squared_error = np.zeros(self.n_clients)
+      seen = np.zeros(self.n_clients)
+      while True:
+        batches = [None] * self.n_clients
+        for c, it in enumerate(iterators):
+          if it is not None:
+            batches[c] = next(it, None)
+            if batches[c] is None:
+              iterators[c] = None
+        active = np.array([b is not None for b in batches], dtype=np.float32)
+        if not active.any():
+          break
+        present = [b for b in batches if b is not None]
+        x = {k: tf.concat([b[0][k] for b in present], axis=0) for k in present[0][0]}
+        feats = self.feature_model(x, training=False).numpy()
+        sizes = np.array([len(b[1]) if b is not None else 0 for b in batches])
+        width = sizes.max()
+        # scatter the concatenated rows into a zero padded (clients, width, ...) stack
+        rows = np.repeat(np.arange(self.n_clients), sizes)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        feat_stack = np.zeros((self.n_clients, width, feats.shape[-1]), dtype=feats.dtype)
+        feat_stack[rows, cols] = feats
+        y_stack = np.zeros((self.n_clients, width), dtype=np.float32)
+        y_stack[rows, cols] = np.concatenate([np.reshape(b[1], [-1]) for b in present])
+        mask = np.zeros((self.n_clients, width), dtype=np.float32)
+        mask[rows, cols] = 1
+        per_client, n_correct, sq_err = self._step(feat_stack, y_stack, mask, active)
+        loss_sum += per_client.numpy() * active
+        steps += active
+        correct += n_correct.numpy()
+        squared_error += sq_err.numpy()
+        seen += sizes
+    seen = np.maximum(seen, 1)
+    return {
+      'loss': loss_sum / np.maximum(steps, 1),
+      'accuracy': correct / seen,
+      'mse': squared_error / seen,
+    }
+
+
 def train_and_log_metrics(
     model,
     tfds_train,
@@ -133,23 +421,29 @@ def build_and_evaluate(
     epoch=100,
     model_name='model',
     csv_metrics_filepath ='metrics',
+    stats=None,
+    template=None,
   ):
 
   """Composite function, or a wrapper, for all of the above.
 
   A Wrapper for ease of modelling and training of a given dataset
-  into the generator made previously.
+  into the generator made previously. With a ModelTemplate the model
+  is cloned from it instead of being built and adapted again.
   """
 
   model_metrics = ['accuracy', 'mse', tf.keras.metrics.BinaryAccuracy()]
 
-  model = build_model(
-    tfds_train,
-    data_loader,
-    name=model_name
-  )
-
-  compile_model(model, metrics=model_metrics)
+  if template is not None:
+    model = template.new_model(name=model_name, metrics=model_metrics)
+  else:
+    model = build_model(
+      tfds_train,
+      data_loader,
+      name=model_name,
+      stats=stats
+    )
+    compile_model(model, metrics=model_metrics)
 
   _model, logger, history = train_and_log_metrics(
     model,
@@ -1,7 +1,9 @@
 import numpy as np
-from src.request_utils import get_request
-from src.archive_utils import unload_zip_from_io
+from src.request_utils import get_request, DownloadCache
+from src.archive_utils import unload_zip_from_io, open_zip_member
+from src.table_cache import table_cache_key, save_tables, load_tables
 from pathlib import Path
+from contextlib import contextmanager
 import pandas as pd
 
 
@@ -21,6 +23,7 @@ class ExampleDataLoader:
 
   archive_url = 'https://files.grouplens.org/datasets/movielens/ml-100k.zip'
   archive_dir = 'data/ex2'
+  table_cache_dir = '.table_cache'
 
   data_dir = {
     'users': {
@@ -28,14 +31,14 @@ class ExampleDataLoader:
       'delimiter': '|',
       'encoding': 'latin-1',
       'headers': ['user_id', 'age', 'sex', 'occupation', 'zip_code'],
-      'types': ['int', 'uint8', 'string', 'string', 'string']
+      'types': ['int32', 'uint8', 'category', 'category', 'category']
     },
     'ratings': {
       'filename': 'u.data',
       'delimiter': '\t',
       'encoding': 'latin-1',
       'headers': ['user_id', 'movie_id', 'rating', 'unix_timestamp'],
-      'types': ['int', 'int', 'float64', 'uint64']
+      'types': ['int32', 'int32', 'float32', 'uint32']
     },
     'movies': {
       'filename': 'u.item',
@@ -46,7 +49,7 @@ class ExampleDataLoader:
       'Crime', 'Documentary', 'Drama', 'Fantasy', 'Film-Noir', 'Horror',
       'Musical', 'Mystery', 'Romance', 'Sci-Fi', 'Thriller', 'War', 'Western'
       ],
-      'types': ['int', 'string', 'string', 'string', 'string',
+      'types': ['int32', 'string', 'string', 'string', 'string',
       'uint8', 'uint8', 'uint8', 'uint8', 'uint8', 'uint8',
       'uint8', 'uint8', 'uint8', 'uint8', 'uint8', 'uint8',
       'uint8', 'uint8', 'uint8', 'uint8', 'uint8', 'uint8', 'uint8'
@@ -54,6 +57,13 @@ class ExampleDataLoader:
     },
   }
 
+  # ids are factorized into contiguous zero-based int32 codes, the table
+  # holding the full id set defines the codes of every other table
+  data_id_sources = {
+    'user_id': 'users',
+    'movie_id': 'movies',
+  }
+
   data_feature_cols = {
     'users': ['user_id', 'age', 'sex', 'occupation', 'zip_code'],
     'ratings': ['rating'], # 'unix_timestamp'
@@ -67,16 +77,7 @@ class ExampleDataLoader:
   ]
 
   data_converters = {
-    'users': {
-      'user_id': lambda x: str(int(x)-1)
-    },
-    'ratings': {
-      # 'unix_timestamp': lambda x: np.datetime64('1970-01-01') + np.timedelta64(x, 's'),
-      'user_id': lambda x: str(int(x)-1),
-      'movie_id': lambda x: str(int(x)-1),
-    },
     'movies': {
-      'movie_id': lambda x: str(int(x)-1),
       'release_date': _date_parser
     }
   }
@@ -90,57 +91,142 @@ class ExampleDataLoader:
 
     self.mapped_features = {
       'users': {
-        'user_id': {'incr': -1}
+        'user_id': {'factorized': True}
       },
       'ratings': {
-        'user_id': {'incr': -1},
-        'movie_id': {'incr': -1},
+        'user_id': {'factorized': True},
+        'movie_id': {'factorized': True},
       },
       'movies': {
-        'movie_id': {'incr': -1},
+        'movie_id': {'factorized': True},
       }
     }
 
+    # original ids, indexed by the factorized id
+    self.id_lookup = {}
+    # when set, tables are read from the archive instead of archive_dir
+    self.archive_file = None
+
     self._header_dict = {}
     self._header_dict_is_loaded = False
 
-  def download(self, to_folder=None):
+  def download(self, to_folder=None, extract=True):
     if not to_folder or to_folder is None:
       to_folder = self.archive_dir
     else:
       self.archive_dir = to_folder
-    b = get_request(self.archive_url)
-    unload_zip_from_io(b, to_folder)
-    b.close()
+    if extract:
+      with get_request(self.archive_url) as b:
+        unload_zip_from_io(b, to_folder, members=[tb_info['filename'] for tb_info in self.data_dir.values()])
+    else:
+      # tables are read from the archive later, so it has to stay put:
+      # the download cache blob does, a temp download may not
+      self.archive_file = DownloadCache().fetch(self.archive_url)
     return self
 
-  def load(self):
+  def _data_file_path(self, tb_info):
+    data_glob_path = list(Path(self.archive_dir).rglob(tb_info['filename']))
+    return next(filter(lambda x: x.is_file(), data_glob_path))
+
+  @contextmanager
+  def _data_source(self, tb_info):
+    if self.archive_file is None:
+      yield self._data_file_path(tb_info)
+    else:
+      with open_zip_member(self.archive_file, tb_info['filename']) as fp:
+        yield fp
+
+  def load(self, use_cache=True):
+    if self.archive_file is None:
+      source_paths = [self._data_file_path(tb_info) for tb_info in self.data_dir.values()]
+    else:
+      source_paths = [self.archive_file]
+
+    if use_cache:
+      spec = {'loader': f'{self.__class__.__module__}.{self.__class__.__name__}', 'data_dir': self.data_dir}
+      cache_key = table_cache_key(spec, source_paths, self.data_converters)
+      cache_dir = Path(self.archive_dir) / self.table_cache_dir / cache_key
+      tables = load_tables(cache_dir)
+      if tables is not None:
+        for col in self.data_id_sources:
+          self.id_lookup[col] = tables.pop(f'lookup_{col}')[col].to_numpy()
+        for tb_name, df in tables.items():
+          setattr(self, f'df_{tb_name}', df)
+        return self
+
     for tb_name, tb_info in self.data_dir.items():
-      data_glob_path = list(Path(self.archive_dir).rglob(tb_info['filename']))
-      data_file_path = next(filter(lambda x: x.is_file(), data_glob_path))
-      df = pd.read_csv(
-        data_file_path,
-        names=tb_info['headers'],
-        sep=tb_info['delimiter'],
-        encoding=tb_info['encoding'],
-        dtype=dict(zip(tb_info['headers'], tb_info['types'])),
-        converters=self.data_converters.get(tb_name)
-      )
-      setattr(self, f'df_{tb_name}', df)
+      with self._data_source(tb_info) as source:
+        setattr(self, f'df_{tb_name}', self._read_table(source, tb_name, tb_info))
+    self._factorize_ids()
+
+    if use_cache:
+      tables = {tb_name: getattr(self, f'df_{tb_name}') for tb_name in self.data_dir}
+      for col, lookup in self.id_lookup.items():
+        tables[f'lookup_{col}'] = pd.DataFrame({col: lookup})
+      save_tables(cache_dir, tables)
     return self
 
+  def _read_table(self, data_file_path, tb_name, tb_info, chunksize=None):
+    converters = self.data_converters.get(tb_name, {})
+    dtype = {k: v for k, v in zip(tb_info['headers'], tb_info['types']) if k not in converters}
+    delimiter = tb_info['delimiter']
+    kwargs = {'encoding': tb_info['encoding'], 'dtype': dtype, 'converters': converters, 'chunksize': chunksize}
+    if tb_info.get('single_char_fields') and len(delimiter) > 1 and len(set(delimiter)) == 1:
+      # fields never contain the delimiter character, so a repeated
+      # delimiter can be split by the C engine with empty gap columns
+      n = len(tb_info['headers'])
+      step = len(delimiter)
+      names = [f'_{i}' for i in range((n - 1) * step + 1)]
+      for i, header in enumerate(tb_info['headers']):
+        names[i * step] = header
+      reader = pd.read_csv(data_file_path, names=names, usecols=tb_info['headers'], sep=delimiter[0], engine='c', **kwargs)
+      if chunksize is None:
+        return reader[tb_info['headers']]
+      return (chunk[tb_info['headers']] for chunk in reader)
+    return pd.read_csv(
+      data_file_path,
+      names=tb_info['headers'],
+      sep=delimiter,
+      engine='python' if len(delimiter) > 1 else 'c',
+      **kwargs
+    )
+
+  def _factorize_ids(self, tb_names=None):
+    tb_names = list(self.data_dir) if tb_names is None else tb_names
+    for col, src_tb_name in self.data_id_sources.items():
+      self.id_lookup[col] = np.unique(getattr(self, f'df_{src_tb_name}')[col].to_numpy())
+      for tb_name in tb_names:
+        if col not in self.data_dir[tb_name]['headers']:
+          continue
+        df = getattr(self, f'df_{tb_name}')
+        df[col] = self._factorize_column(col, df[col].to_numpy(), tb_name)
+
+  def _factorize_column(self, col, raw, tb_name):
+    lookup = self.id_lookup[col]
+    codes = np.searchsorted(lookup, raw)
+    codes[codes >= len(lookup)] = 0
+    if not np.array_equal(lookup[codes], raw):
+      raise ValueError(f'{tb_name}.{col} contains ids missing from {self.data_id_sources[col]}')
+    return codes.astype(np.int32)
+
+  def to_raw_ids(self, col, ids):
+    return self.id_lookup[col][np.asarray(ids)]
+
+  def from_raw_ids(self, col, raw_ids):
+    return np.searchsorted(self.id_lookup[col], np.asarray(raw_ids)).astype(np.int32)
+
   def remap(self):
-    self.mapped_features['ratings'] = {}
-    self.mapped_features['ratings']['rating'] = {}
-    __rating_max = np.argmax(self.df_ratings['rating'].to_numpy())
-    __rating_min = np.argmin(self.df_ratings['rating'].to_numpy())
+    ratings = self.df_ratings['rating'].to_numpy()
+    __rating_max = ratings.max()
+    __rating_min = ratings.min()
     __rating_len = __rating_max - __rating_min
 
+    self.mapped_features['ratings']['rating'] = {}
     self.mapped_features['ratings']['rating']['max'] = __rating_max
     self.mapped_features['ratings']['rating']['min'] = __rating_min
     self.mapped_features['ratings']['rating']['len'] = __rating_len
 
-    self.df_ratings['rating'] = self.df_ratings['rating'].apply(lambda x: (x - __rating_min) / __rating_len)
+    self.df_ratings['rating'] = ((ratings - __rating_min) / __rating_len).astype(np.float32)
     return self
 
 
@@ -174,6 +260,74 @@ class ExampleDataLoader:
     return self
 
 
+  def _lookup_arrays(self, tb_name, id_col):
+    # columns of a small table reordered so that row i belongs to id i
+    df = getattr(self, f'df_{tb_name}')
+    order = np.zeros(len(self.id_lookup[id_col]), dtype=np.int64)
+    order[df[id_col].to_numpy()] = np.arange(len(df))
+    lookup = {}
+    for col in df.columns:
+      if col == id_col:
+        continue
+      values = df[col].to_numpy() if isinstance(df[col].dtype, np.dtype) else df[col].array
+      lookup[col] = values.take(order)
+    return lookup
+
+  def stream(self, chunk_size=2**18, client_index=None, columns=None):
+    """Yield the ratings in chunks of `chunk_size` rows, joined like merge().
+
+    Only the ratings file is read incrementally. Users and movies are
+    loaded (if not already) and kept as lookup arrays indexed by the
+    factorized ids, so memory stays bounded by one chunk whatever the size
+    of the ratings file. Ratings are normalized when remap() ranges are set
+    in mapped_features.
+
+    Args:
+        client_index[optional]: client id per factorized user id, or a
+          callable taking the joined chunk and returning a client id per row.
+          When given, (client, chunk) pairs are yielded instead of chunks,
+          rows keep their file order within a client.
+        columns[optional]: output columns, defaults to all merged columns
+    """
+    lookup_tables = [tb for tb in self.data_dir if tb in self.data_id_sources.values()]
+    if any(getattr(self, f'df_{tb}') is None for tb in lookup_tables):
+      for tb in lookup_tables:
+        with self._data_source(self.data_dir[tb]) as source:
+          setattr(self, f'df_{tb}', self._read_table(source, tb, self.data_dir[tb]))
+      self._factorize_ids(lookup_tables)
+    lookups = {col: self._lookup_arrays(tb, col) for col, tb in self.data_id_sources.items()}
+    rating_range = self.mapped_features['ratings'].get('rating')
+
+    tb_info = self.data_dir['ratings']
+    with self._data_source(tb_info) as source:
+      for chunk in self._read_table(source, 'ratings', tb_info, chunksize=chunk_size):
+        data = {col: chunk[col].to_numpy() for col in chunk.columns}
+        for col in lookups:
+          data[col] = self._factorize_column(col, data[col], 'ratings')
+        if rating_range is not None:
+          data['rating'] = ((data['rating'] - rating_range['min']) / rating_range['len']).astype(np.float32)
+        for col, lookup in lookups.items():
+          ids = data[col]
+          for name, values in lookup.items():
+            data[name] = values.take(ids)
+        df = pd.DataFrame(data, copy=False)
+        if columns is not None:
+          df = df[columns]
+
+        if client_index is None:
+          yield df
+          continue
+        if callable(client_index):
+          clients = np.asarray(client_index(df))
+        else:
+          clients = np.asarray(client_index)[data['user_id']]
+        order = np.argsort(clients, kind='stable')
+        clients = clients[order]
+        df = df.take(order)
+        bounds = np.r_[0, np.flatnonzero(clients[1:] != clients[:-1]) + 1, len(clients)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+          yield clients[lo], df.iloc[lo:hi]
+
   def get_feature_values(self, feature_col:str, tb_name=None):
     if tb_name is not None:
       values = getattr(self, f'df_{tb_name}')[feature_col].unique()
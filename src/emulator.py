@@ -1,42 +1,60 @@
+import sys
 import time
+import random
+import asyncio
 import logging
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from src.content_cache import ContentCache
+from src.event_log import EventLog, EventCode
+from src.node_metrics import NodeMetrics
 
 class __TreeNode:
+  """Tree node with a name -> child index.
+
+  Children are kept in insertion order with their position stored on the
+  child, so appending is O(1) and siblings are sliced on demand instead
+  of being stored on every node.
+  """
+  __slots__ = ('name', 'parent', 'children', '_child_index', '_position')
+
   def __init__(self, name=None, parent=None):
     self.name = str(id(self)) if name is None else name
     self.parent = parent
-    self.left_siblings = []
-    self.right_siblings = []
     self.children = []
-    self._scan_siblings()
+    self._child_index = {}
+    self._position = None
 
   @property
   def num_child(self):
     return len(self.children)
 
+  @property
+  def left_siblings(self):
+    if self.parent is None or self._position is None:
+      return []
+    return self.parent.children[:self._position]
+
+  @property
+  def right_siblings(self):
+    if self.parent is None or self._position is None:
+      return []
+    return self.parent.children[self._position+1:]
+
   def _append_child(self, child: "__TreeNode"):
+    child._position = len(self.children)
     self.children.append(child)
-    for child in self.children:
-      child._scan_siblings()
-
-  def _scan_siblings(self):
-    if self.parent is None:
-      return
-    if self.parent.num_child == 0:
-      return
-    if not self in self.parent.children:
-      return
-    index_self = self.parent.children.index(self)
-    self.left_siblings = self.parent.children[:index_self]
-    self.right_siblings = self.parent.children[index_self+1:]
+    self._child_index.setdefault(child.name, child)
 
   def __repr__(self):
     return f'<{self.__class__.__name__}: {self.name}{"  num_child: " + str(self.num_child) if self.num_child > 0 else ""}  parent: {self.parent.name if not self.parent is None else None}>'
 
 
 class TaskWrapper:
+  __slots__ = ('name', 'task_fn', 'host', 'host_logger', 'has_logger', 'state', 'task_cfg', 'in_flight')
   verbose = True
-  
+
   def __init__(self, name=None, host=None):
     self.name = str(id(self)) if name is None else name
     self.task_fn = None
@@ -44,6 +62,7 @@ class TaskWrapper:
     self.host_logger : logging.Logger = None
     self.has_logger = False
     self.state = 'stopped'
+    self.in_flight = 0
     self.task_cfg = {
       'run_once': False,
     }
@@ -55,10 +74,22 @@ class TaskWrapper:
     self.host_logger = self.host.logger
     self.has_logger = True
 
-  def log_event(self, msg=''):
-    if not self.has_logger:
+  def log_event(self, event=EventCode.TASK, obj=-1, nbytes=0, ts=None):
+    """Record an event in the host's EventLog.
+
+    Args:
+        event: EventCode, a str message goes to the host logger instead
+        obj[optional]: object id, e.g. the requested movie id
+        nbytes[optional]: bytes involved
+        ts[optional]: timestamp, defaults to time.perf_counter_ns()
+    """
+    if isinstance(event, str):
+      if self.has_logger:
+        self.host_logger.info(event)
       return
-    self.host_logger.info(msg)
+    event_log = self.host.event_log
+    if event_log is not None:
+      event_log.record(event, self.host.node_id, obj, nbytes, ts)
 
   def set_host(self, host: "UnitProcess"):
     self.host = host
@@ -68,22 +99,73 @@ class TaskWrapper:
     self.task_fn = task_fn
 
   def run_task(self, *args, **kwargs):
+    """Run the task and return its result, coroutine tasks run to completion."""
     if self.task_cfg.get('run_once') and self.state == 'finished':
-      return
+      return None
     self.state = 'running'
-    self.task_fn(self, *args, **kwargs)
+    metrics = self.host.metrics if self.host is not None else None
+    start = time.perf_counter_ns() if metrics is not None else 0
+    result = self.task_fn(self, *args, **kwargs)
+    if asyncio.iscoroutine(result):
+      result = _run_coroutine(result)
+    if metrics is not None:
+      metrics.observe(self.name, time.perf_counter_ns() - start)
     self.state = 'finished'
+    return result
+
+  async def run_task_async(self, *args, **kwargs):
+    """Await the task when it is a coroutine function, sync tasks run inline.
+
+    Several coroutines may run the same task at once, `in_flight` counts
+    them and the state is 'finished' once the last one returns. A
+    run_once task is not started again while a call is in flight. The
+    latency recorded in the host metrics is wall time, including the
+    time the task spends suspended at awaits.
+    """
+    if self.task_cfg.get('run_once') and (self.in_flight or self.state == 'finished'):
+      return None
+    self.in_flight += 1
+    self.state = 'running'
+    metrics = self.host.metrics if self.host is not None else None
+    start = time.perf_counter_ns() if metrics is not None else 0
+    try:
+      result = self.task_fn(self, *args, **kwargs)
+      if asyncio.iscoroutine(result):
+        result = await result
+    finally:
+      self.in_flight -= 1
+    if metrics is not None:
+      metrics.observe(self.name, time.perf_counter_ns() - start)
+    if not self.in_flight:
+      self.state = 'finished'
+    return result
 
   def __repr__(self):
     return f'<{self.__class__.__name__}: {self.name} state:  {self.state}>'
 
 
 class UnitProcess(__TreeNode):
+  __slots__ = (
+    'task_queue', 'local_vars', 'logger', 'event_log', 'node_id', 'metrics',
+    'exec_cfg', '_executor', '_exec_round',
+  )
+
   def __init__(self, name=None, parent=None):
     super().__init__(name=name, parent=parent)
     self.task_queue = {}
     self.local_vars = {}
     self.logger = None
+    self.event_log = None
+    self.node_id = -1
+    self.metrics = None
+    self.exec_cfg = {
+      'mode': 'sequential',
+      'max_workers': None,
+      'mp_context': None,
+      'seed': None,
+    }
+    self._executor = None
+    self._exec_round = 0
 
   def create_task(self, name=None):
     task = TaskWrapper(name=name)
@@ -93,17 +175,38 @@ class UnitProcess(__TreeNode):
 
   def run_task(self, name, *args, **kwargs):
     if not name in self.task_queue:
-      return
+      return None
+    kwargs.update({'host': self, 'local_vars': self.local_vars})
+    return self.task_queue[name].run_task(*args, **kwargs)
+
+  async def run_task_async(self, name, *args, **kwargs):
+    if not name in self.task_queue:
+      return None
     kwargs.update({'host': self, 'local_vars': self.local_vars})
-    self.task_queue[name].run_task(*args, **kwargs)
+    return await self.task_queue[name].run_task_async(*args, **kwargs)
+
+  async def request(self, name, *args, **kwargs):
+    """Await a task of this node and return its result.
+
+    Meant for async tasks calling up or across the tree, e.g.
+    `content = await host.parent.request('handle_request', ...)`.
+    Unlike run_task_async() a missing task raises KeyError.
+    """
+    if not name in self.task_queue:
+      raise KeyError(f'{self.name} has no task {name}')
+    return await self.run_task_async(name, *args, **kwargs)
 
   def run_all_tasks(self, *args, **kwargs):
     for k in self.task_queue.keys():
-      self.run_task(k, *kwargs, **kwargs)
+      self.run_task(k, *args, **kwargs)
 
   def spawn_child(self, name=None):
     child = self.__class__(name=name, parent=self)
     self._append_child(child=child)
+    if self.event_log is not None:
+      child.set_event_log(self.event_log)
+    if self.metrics is not None:
+      child.enable_metrics()
     return child
 
   def spawn_self(self, name=None):
@@ -118,18 +221,436 @@ class UnitProcess(__TreeNode):
     self._append_child(child=other)
 
   def get_child_by_name(self, name):
-    for child in self.children:
-      if child.name == name:
-        return child
-    return None
+    return self._child_index.get(name)
 
   def force_run_children_tasks(self, *args, **kwargs):
-    for child in self.children:
-      child.run_all_tasks(*args, **kwargs)
+    self._run_children(None, args, kwargs)
+
+  def run_children_task(self, name, *args, children=None, **kwargs):
+    self._run_children(name, args, kwargs, children=children)
+
+  async def run_children_task_async(self, name, *args, children=None, max_concurrency=None, **kwargs):
+    """Run a task on the children concurrently on the running event loop.
+
+    Args:
+        name: task name, None runs all tasks of every child
+        children[optional]: subset of the children to run
+        max_concurrency[optional]: children in flight at once, defaults
+          to exec_cfg['max_workers'], unbounded when both are None
+
+    Returns:
+        list of the task results in children order
+    """
+    children = self.children if children is None else list(children)
+    seeds = self._child_seeds(children)
+    if max_concurrency is None:
+      max_concurrency = self.exec_cfg['max_workers']
+    return await _gather_children(children, seeds, name, args, kwargs, max_concurrency)
+
+  def set_exec_cfg(self, **cfg):
+    """Configure how children tasks are executed.
+
+    Args:
+        mode: 'sequential' (default), 'thread', 'process' or 'async'.
+          Sibling subtrees run concurrently in the pool; in 'async' mode
+          children are coroutines on one event loop, at most max_workers
+          in flight, and sync tasks run inline; in 'process' mode each
+          child subtree (tasks and local_vars) is pickled to a worker and
+          its local_vars are copied back afterwards, so task functions
+          must be importable and tasks may not reach outside the subtree
+        max_workers: pool size, defaults to the executor default
+          (unbounded in 'async' mode)
+        mp_context: multiprocessing start method for 'process' mode
+        seed: when set, every child gets local_vars['rng'], a NumPy
+          Generator derived from (seed, call count, child index), and in
+          'sequential'/'process' mode `random`, `numpy.random` and
+          TensorFlow are seeded from it before the child runs
+    """
+    if cfg.get('mode', self.exec_cfg['mode']) not in ('sequential', 'thread', 'process', 'async'):
+      raise ValueError(f'unknown execution mode: {cfg.get("mode")}')
+    self.shutdown_executor()
+    self.exec_cfg.update(cfg)
+    return self
+
+  def shutdown_executor(self):
+    if self._executor is not None:
+      self._executor.shutdown()
+      self._executor = None
+
+  def _get_executor(self):
+    if self._executor is None:
+      if self.exec_cfg['mode'] == 'thread':
+        self._executor = ThreadPoolExecutor(max_workers=self.exec_cfg['max_workers'])
+      else:
+        mp_context = self.exec_cfg['mp_context']
+        self._executor = ProcessPoolExecutor(
+          max_workers=self.exec_cfg['max_workers'],
+          mp_context=get_context(mp_context) if mp_context is not None else None
+        )
+    return self._executor
+
+  def _child_seeds(self, children):
+    seed = self.exec_cfg['seed']
+    self._exec_round += 1
+    if seed is None:
+      return [None] * len(children)
+    seq = np.random.SeedSequence(seed, spawn_key=(self._exec_round,))
+    child_seqs = seq.spawn(self.num_child)
+    position = {id(child): i for i, child in enumerate(self.children)}
+    return [int(child_seqs[position[id(c)]].generate_state(1)[0]) for c in children]
+
+  def _run_children(self, task_name, args, kwargs, children=None):
+    mode = self.exec_cfg['mode']
+    children = self.children if children is None else list(children)
+    seeds = self._child_seeds(children)
+
+    if mode == 'sequential':
+      for child, seed in zip(children, seeds):
+        _seed_child(child, seed, seed_globals=True)
+        _run_node(child, task_name, args, kwargs)
+      return
+
+    if mode == 'async':
+      _run_coroutine(_gather_children(children, seeds, task_name, args, kwargs, self.exec_cfg['max_workers']))
+      return
+
+    executor = self._get_executor()
+    if mode == 'thread':
+      futures = []
+      for child, seed in zip(children, seeds):
+        _seed_child(child, seed, seed_globals=False)
+        futures.append(executor.submit(_run_node, child, task_name, args, kwargs))
+      for future in futures:
+        future.result()
+      return
+
+    futures = [
+      executor.submit(_run_subtree_worker, _export_subtree(child), task_name, seed, args, kwargs)
+      for child, seed in zip(children, seeds)
+    ]
+    for child, future in zip(children, futures):
+      _apply_subtree_state(child, future.result())
 
   def set_logger(self, logger):
     self.logger = logger
 
+  def set_event_log(self, event_log: EventLog, recursive=True):
+    """Record the events of this node (and its subtree) into `event_log`.
+
+    Children spawned later inherit it. Events of subtrees run in
+    'process' mode stay in the worker and are not recorded. Node names
+    must be unique among the nodes of one log, ValueError otherwise.
+    """
+    self.event_log = event_log
+    self.node_id = event_log.node_id(self.name, owner=self) if event_log is not None else -1
+    if recursive:
+      for child in self.children:
+        child.set_event_log(event_log)
+
+  def enable_metrics(self, recursive=True):
+    """Keep counters and task wall-time histograms in `self.metrics`.
+
+    Disabled (the default) the metrics are None, which costs one
+    attribute check per task call or count().
+    """
+    if self.metrics is None:
+      self.metrics = NodeMetrics()
+    if recursive:
+      for child in self.children:
+        child.enable_metrics()
+    return self
+
+  def disable_metrics(self, recursive=True):
+    self.metrics = None
+    if recursive:
+      for child in self.children:
+        child.disable_metrics()
+
+  def count(self, name, value=1):
+    """Add to a counter of this node, e.g. host.count('bytes_served', size) in a task."""
+    metrics = self.metrics
+    if metrics is not None:
+      metrics.counters[name] = metrics.counters.get(name, 0) + value
+
+  def collect_metrics(self):
+    """Metrics of this node merged with its whole subtree."""
+    total = NodeMetrics()
+    if self.metrics is not None:
+      total.merge(self.metrics)
+    for child in self.children:
+      total.merge(child.collect_metrics())
+    return total
+
+  def metrics_snapshot(self):
+    """Snapshot of every node of the subtree.
+
+    Node names must be unique within the subtree, ValueError otherwise.
+
+    Returns:
+        dict of node name -> {'node': own metrics, 'subtree': metrics
+        aggregated over the node and its descendants}
+    """
+    snapshots = {}
+    def visit(node):
+      if node.name in snapshots:
+        raise ValueError(f'duplicate node name in metrics snapshot: {node.name!r}')
+      snapshots[node.name] = None
+      total = NodeMetrics()
+      if node.metrics is not None:
+        total.merge(node.metrics)
+      for child in node.children:
+        total.merge(visit(child))
+      snapshots[node.name] = {
+        'node': node.metrics.snapshot() if node.metrics is not None else None,
+        'subtree': total.snapshot(),
+      }
+      return total
+    visit(self)
+    return snapshots
+
+  def create_cache(self, alloc, policy='lru', **kwargs):
+    cache = ContentCache(alloc, policy=policy, **kwargs)
+    self.local_vars['cache'] = cache
+    return cache
+
+def _run_node(node, task_name, args, kwargs):
+  if task_name is None:
+    node.run_all_tasks(*args, **kwargs)
+  else:
+    node.run_task(task_name, *args, **kwargs)
+
+async def _run_node_async(node, task_name, args, kwargs):
+  if task_name is None:
+    for name in list(node.task_queue):
+      await node.run_task_async(name, *args, **kwargs)
+    return None
+  return await node.run_task_async(task_name, *args, **kwargs)
+
+async def _gather_children(children, seeds, task_name, args, kwargs, max_concurrency):
+  for child, seed in zip(children, seeds):
+    _seed_child(child, seed, seed_globals=False)
+  if not max_concurrency or max_concurrency >= len(children):
+    return list(await _gather_or_cancel(_run_node_async(c, task_name, args, kwargs) for c in children))
+  # bounded: a fixed pool of workers pulls the children in order
+  results = [None] * len(children)
+  pending = iter(enumerate(children))
+  async def worker():
+    for i, child in pending:
+      results[i] = await _run_node_async(child, task_name, args, kwargs)
+  await _gather_or_cancel(worker() for _ in range(max_concurrency))
+  return results
+
+async def _gather_or_cancel(coros):
+  # the first failure cancels the other tasks instead of leaving them running
+  tasks = [asyncio.ensure_future(coro) for coro in coros]
+  try:
+    return await asyncio.gather(*tasks)
+  except BaseException:
+    for task in tasks:
+      task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    raise
+
+def _run_coroutine(coro):
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coro)
+  coro.close()
+  raise RuntimeError('async task run synchronously inside a running event loop, await run_task_async() or request() instead')
+
+def _seed_child(node, seed, seed_globals):
+  if seed is None:
+    return
+  node.local_vars['rng'] = np.random.default_rng(seed)
+  if not seed_globals:
+    return
+  random.seed(seed)
+  np.random.seed(seed % 2**32)
+  if 'tensorflow' in sys.modules:
+    sys.modules['tensorflow'].random.set_seed(seed % 2**31)
+
+def _export_subtree(node):
+  return {
+    'cls': node.__class__,
+    'name': node.name,
+    'local_vars': node.local_vars,
+    'metrics': node.metrics,
+    'tasks': [(t.name, t.task_fn, t.task_cfg, t.state) for t in node.task_queue.values()],
+    'children': [_export_subtree(child) for child in node.children],
+  }
+
+def _import_subtree(spec, parent=None):
+  node = spec['cls'](name=spec['name'], parent=parent)
+  if parent is not None:
+    parent._append_child(child=node)
+  node.local_vars = spec['local_vars']
+  node.metrics = spec['metrics']
+  for name, task_fn, task_cfg, state in spec['tasks']:
+    task = node.create_task(name)
+    task.set_task(task_fn)
+    task.task_cfg = task_cfg
+    task.state = state
+  for child_spec in spec['children']:
+    _import_subtree(child_spec, parent=node)
+  return node
+
+def _export_subtree_state(node):
+  return {
+    'local_vars': node.local_vars,
+    'metrics': node.metrics,
+    'states': {name: t.state for name, t in node.task_queue.items()},
+    'children': [_export_subtree_state(child) for child in node.children],
+  }
+
+def _apply_subtree_state(node, state):
+  node.local_vars.clear()
+  node.local_vars.update(state['local_vars'])
+  node.metrics = state['metrics']
+  for name, task_state in state['states'].items():
+    node.task_queue[name].state = task_state
+  for child, child_state in zip(node.children, state['children']):
+    _apply_subtree_state(child, child_state)
+
+def _run_subtree_worker(spec, task_name, seed, args, kwargs):
+  node = _import_subtree(spec)
+  _seed_child(node, seed, seed_globals=True)
+  _run_node(node, task_name, args, kwargs)
+  return _export_subtree_state(node)
+
+def _node_depth(node):
+  depth = 0
+  while node.parent is not None:
+    node = node.parent
+    depth += 1
+  return depth
+
+def _assignment_to_index(user_ids, assignment, n_clients):
+  idx = _assignment_lookup(user_ids, assignment)
+  # out of range indices would silently fall out of the per client groups
+  bad = (idx < 0) | (idx >= n_clients)
+  if bad.any():
+    raise ValueError(f'client indices outside [0, {n_clients}) in the assignment: {np.unique(idx[bad])[:10].tolist()}')
+  return idx
+
+def _assignment_lookup(user_ids, assignment):
+  if isinstance(assignment, dict):
+    keys = np.asarray(list(assignment.keys()))
+    values = np.asarray(list(assignment.values()))
+    order = np.argsort(keys, kind='stable')
+    keys, values = keys[order], values[order]
+    pos = np.searchsorted(keys, user_ids)
+    pos[pos >= len(keys)] = 0
+    if not np.array_equal(keys[pos], user_ids):
+      raise KeyError('trace contains users missing from the client assignment')
+    return values[pos]
+  return np.asarray(assignment)[user_ids]
+
+def replay_trace(root, user_ids, object_ids, assignment, timestamps=None, sizes=1, clients=None, event_log=None):
+  """Batch replay of a request trace through a UnitProcess hierarchy.
+
+  Equivalent to sending every request through the event-by-event
+  `invoke_content_request` -> parent `handle_request` tasks, but without
+  per-request task dispatch: requests are grouped per client with NumPy,
+  each node runs one tight loop over its ContentCache, and its misses are
+  forwarded in trace order to the parent, deepest tier first. Since a
+  node's cache state only depends on the ordered stream of requests it
+  receives, the result matches the event-by-event replay for the same
+  caches and policy. Caches are read from `local_vars['cache']` and
+  updated in place, nodes without one forward every request. Nodes with
+  metrics enabled get the same counts added to their counters.
+
+  Args:
+      root: top node of the hierarchy, its misses go to the origin
+      user_ids: user id per request
+      object_ids: requested object (movie) id per request
+      assignment: dict or array mapping user id to a client index,
+        indices outside the clients raise ValueError
+      timestamps[optional]: request times, the trace is stably sorted
+        by them when given
+      sizes[optional]: scalar size, or array indexed by object id
+      clients[optional]: client nodes indexed by the assignment,
+        defaults to root.children
+      event_log[optional]: EventLog receiving a CACHE_HIT or CACHE_MISS
+        event per request and node, stamped with the trace timestamps
+        when given
+
+  Returns:
+      dict of node name -> requests, hits, misses, bytes_served and
+      bytes_fetched (bytes requested upstream on a miss)
+  """
+  user_ids = np.asarray(user_ids)
+  object_ids = np.asarray(object_ids)
+  if timestamps is not None:
+    timestamps = np.asarray(timestamps)
+    order = np.argsort(timestamps, kind='stable')
+    user_ids, object_ids, timestamps = user_ids[order], object_ids[order], timestamps[order]
+
+  if np.ndim(sizes) == 0:
+    req_sizes = np.full(len(object_ids), sizes)
+  else:
+    req_sizes = np.asarray(sizes)[object_ids]
+
+  if clients is None:
+    clients = root.children
+  client_idx = _assignment_to_index(user_ids, assignment, len(clients))
+
+  order = np.argsort(client_idx, kind='stable')
+  bounds = np.searchsorted(client_idx[order], np.arange(len(clients) + 1))
+  levels = {}
+  for i, client in enumerate(clients):
+    positions = order[bounds[i]:bounds[i+1]]
+    if len(positions):
+      level = levels.setdefault(_node_depth(client), {})
+      level.setdefault(id(client), (client, []))[1].append(positions)
+
+  stats = {}
+  for depth in range(max(levels, default=-1), -1, -1):
+    for node, parts in levels.pop(depth, {}).values():
+      positions = parts[0] if len(parts) == 1 else np.sort(np.concatenate(parts))
+      keys = object_ids[positions]
+      keysizes = req_sizes[positions]
+
+      cache = node.local_vars.get('cache')
+      evictions = 0
+      if isinstance(cache, ContentCache):
+        evictions = cache.evictions
+        hit = np.array(cache.access_many(keys.tolist(), keysizes.tolist()), dtype=bool)
+        evictions = cache.evictions - evictions
+      else:
+        hit = np.zeros(len(keys), dtype=bool)
+
+      node_stats = stats.setdefault(node.name, dict.fromkeys(
+        ['requests', 'hits', 'misses', 'bytes_served', 'bytes_fetched'], 0))
+      n_hits = int(hit.sum())
+      node_stats['requests'] += len(keys)
+      node_stats['hits'] += n_hits
+      node_stats['misses'] += len(keys) - n_hits
+      node_stats['bytes_served'] += keysizes[hit].sum().item()
+      node_stats['bytes_fetched'] += keysizes[~hit].sum().item()
+      if node.metrics is not None:
+        node.count('requests', len(keys))
+        node.count('hits', n_hits)
+        node.count('misses', len(keys) - n_hits)
+        node.count('evictions', evictions)
+        node.count('bytes_served', keysizes[hit].sum().item())
+        node.count('bytes_fetched', keysizes[~hit].sum().item())
+      if event_log is not None:
+        event_log.record_many(
+          np.where(hit, EventCode.CACHE_HIT, EventCode.CACHE_MISS),
+          event_log.node_id(node.name, owner=node),
+          keys,
+          keysizes,
+          timestamps[positions] if timestamps is not None else None
+        )
+
+      if node is not root and node.parent is not None and n_hits < len(keys):
+        level = levels.setdefault(depth - 1, {})
+        level.setdefault(id(node.parent), (node.parent, []))[1].append(positions[~hit])
+
+  return stats
+
+
 if __name__ == '__main__':
   root = UnitProcess()
   task_fn = lambda tw, host, local_vars: print(f'{tw=}, {host=}, {local_vars=}')
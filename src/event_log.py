@@ -0,0 +1,251 @@
+import json
+import time
+import threading
+import numpy as np
+import pandas as pd
+from enum import IntEnum
+from pathlib import Path
+
+# Structured event recorder for emulator runs. Events are fixed size rows
+# (code, node, obj, nbytes, ts) written into preallocated column buffers
+# and appended in bulk to one raw .bin file per column, with a meta.json
+# holding dtypes, the node name table and the row count.
+
+_META_FILE = 'meta.json'
+
+
+class EventCode(IntEnum):
+  TASK = 0
+  REQUEST = 1
+  CACHE_HIT = 2
+  CACHE_MISS = 3
+  CACHE_EVICT = 4
+  CACHE_CLEAR = 5
+  DISK_USAGE = 6
+  TRANSFER = 7
+
+
+EVENT_COLUMNS = {
+  'code': np.uint8,
+  'node': np.int32,
+  'obj': np.int64,
+  'nbytes': np.int64,
+  'ts': np.int64,
+}
+
+
+class EventLog:
+  """Typed event recorder backed by preallocated NumPy ring buffers.
+
+  With a `path` the buffers are flushed to the columnar files whenever
+  they fill up (and on flush()/close()), so the file holds every event.
+  Without one the buffers are a ring that keeps the last `capacity`
+  events in memory and counts the overwritten ones in `dropped`.
+
+  Nodes are stored as integer ids, node_id() maps a name to its id. The
+  name is the node's key in the log, so two different nodes registering
+  the same name is an error rather than a merge of their events.
+  Timestamps default to time.perf_counter_ns(), simulated clocks can pass
+  their own.
+
+  Args:
+      path[optional]: output folder of the columnar files
+      capacity[optional]: events buffered in memory
+  """
+  def __init__(self, path=None, capacity=2**16):
+    self.path = Path(path) if path is not None else None
+    self.capacity = capacity
+    self.columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in EVENT_COLUMNS.items()}
+    self.nodes = []
+    self._node_ids = {}
+    self._owners = []
+    self.size = 0
+    self.flushed = 0
+    self.dropped = 0
+    self._lock = threading.Lock()
+    if self.path is not None:
+      self.path.mkdir(parents=True, exist_ok=True)
+      for name in EVENT_COLUMNS:
+        (self.path / f'{name}.bin').write_bytes(b'')
+      self._write_meta()
+
+  def node_id(self, name, owner=None):
+    """Id of `name`, registered on first use.
+
+    Args:
+        owner[optional]: object the name stands for (e.g. the node), a
+          different owner asking for a registered name raises ValueError
+    """
+    node = self._node_ids.get(name)
+    if node is None:
+      with self._lock:
+        node = self._node_ids.setdefault(name, len(self.nodes))
+        if node == len(self.nodes):
+          self.nodes.append(name)
+          self._owners.append(None)
+    if owner is not None:
+      registered = self._owners[node]
+      if registered is None:
+        self._owners[node] = owner
+      elif registered is not owner:
+        raise ValueError(f'another node is already registered as {name!r} in the event log')
+    return node
+
+  def record(self, code, node, obj=-1, nbytes=0, ts=None):
+    """Append one event, `node` is an id from node_id()."""
+    if ts is None:
+      ts = time.perf_counter_ns()
+    with self._lock:
+      if self.size == self.capacity:
+        self._make_room()
+      i = (self.size + self.dropped) % self.capacity if self.path is None else self.size
+      cols = self.columns
+      cols['code'][i] = code
+      cols['node'][i] = node
+      cols['obj'][i] = obj
+      cols['nbytes'][i] = nbytes
+      cols['ts'][i] = ts
+      self.size += 1
+
+  def record_many(self, code, node, obj=-1, nbytes=0, ts=None):
+    """Append a batch of events, every argument is a scalar or an array."""
+    n = max(np.size(obj), np.size(nbytes), np.size(ts) if ts is not None else 1, np.size(code), np.size(node))
+    if ts is None:
+      ts = time.perf_counter_ns()
+    values = {'code': code, 'node': node, 'obj': obj, 'nbytes': nbytes, 'ts': ts}
+    values = {name: np.broadcast_to(np.asarray(v, dtype=EVENT_COLUMNS[name]), (n,)) for name, v in values.items()}
+    with self._lock:
+      if self.path is None:
+        if n > self.capacity:
+          # only the tail survives the ring
+          self.dropped += n - self.capacity
+          values = {name: v[n - self.capacity:] for name, v in values.items()}
+          n = self.capacity
+        pos = (self.size + self.dropped + np.arange(n)) % self.capacity
+        for name, col in self.columns.items():
+          col[pos] = values[name]
+        overflow = max(self.size + n - self.capacity, 0)
+        self.size += n - overflow
+        self.dropped += overflow
+        return
+      start = 0
+      while start < n:
+        if self.size == self.capacity:
+          self._flush()
+        count = min(n - start, self.capacity - self.size)
+        for name, col in self.columns.items():
+          col[self.size:self.size + count] = values[name][start:start + count]
+        self.size += count
+        start += count
+
+  def _make_room(self):
+    if self.path is not None:
+      self._flush()
+    else:
+      self.size -= 1
+      self.dropped += 1
+
+  def _flush(self):
+    if self.size:
+      for name, col in self.columns.items():
+        with open(self.path / f'{name}.bin', 'ab') as f:
+          col[:self.size].tofile(f)
+      self.flushed += self.size
+      self.size = 0
+    self._write_meta()
+
+  def _write_meta(self):
+    meta = {
+      'columns': {name: np.dtype(dtype).str for name, dtype in EVENT_COLUMNS.items()},
+      'codes': {code.name: int(code) for code in EventCode},
+      'nodes': self.nodes,
+      'rows': self.flushed,
+    }
+    (self.path / _META_FILE).write_text(json.dumps(meta))
+
+  def flush(self):
+    if self.path is None:
+      return
+    with self._lock:
+      self._flush()
+
+  def close(self):
+    self.flush()
+
+  def events(self):
+    """Buffered (not yet flushed) events, oldest first, as a dict of arrays."""
+    with self._lock:
+      if self.path is None and self.dropped:
+        start = self.dropped % self.capacity
+        order = np.roll(np.arange(self.capacity), -start)[:self.size]
+        return {name: col[order] for name, col in self.columns.items()}
+      return {name: col[:self.size].copy() for name, col in self.columns.items()}
+
+  def __len__(self):
+    return self.flushed + self.size
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: {len(self)} events  nodes: {len(self.nodes)}  path: {self.path}>'
+
+
+def load_events(path, mmap=True):
+  """Columns and node names of a flushed event log.
+
+  Returns:
+      (dict of column name -> array, list of node names by id)
+  """
+  path = Path(path)
+  meta = json.loads((path / _META_FILE).read_text())
+  columns = {}
+  for name, dtype in meta['columns'].items():
+    file = path / f'{name}.bin'
+    if mmap and meta['rows']:
+      columns[name] = np.memmap(file, dtype=dtype, mode='r', shape=(meta['rows'],))
+    else:
+      columns[name] = np.fromfile(file, dtype=dtype, count=meta['rows'])
+  return columns, meta['nodes']
+
+def events_to_df(columns, nodes):
+  """Event columns as a DataFrame, codes and nodes as categoricals."""
+  df = pd.DataFrame({name: np.asarray(col) for name, col in columns.items()})
+  df['code'] = pd.Categorical.from_codes(df['code'], categories=[c.name for c in EventCode])
+  df['node'] = pd.Categorical.from_codes(df['node'], categories=nodes)
+  return df
+
+def cache_stats(columns, nodes):
+  """Hits, misses, hit ratio and traffic per node, counted with bincount.
+
+  Returns:
+      dict of node name -> requests, hits, misses, hit_ratio, bytes_served
+      and bytes_fetched
+  """
+  code = np.asarray(columns['code'])
+  node = np.asarray(columns['node'])
+  nbytes = np.asarray(columns['nbytes'])
+  n_nodes = len(nodes)
+  is_hit = code == EventCode.CACHE_HIT
+  is_miss = code == EventCode.CACHE_MISS
+  hits = np.bincount(node[is_hit], minlength=n_nodes)
+  misses = np.bincount(node[is_miss], minlength=n_nodes)
+  served = np.bincount(node[is_hit], weights=nbytes[is_hit], minlength=n_nodes)
+  fetched = np.bincount(node[is_miss], weights=nbytes[is_miss], minlength=n_nodes)
+  stats = {}
+  for i, name in enumerate(nodes):
+    requests = int(hits[i] + misses[i])
+    if requests == 0:
+      continue
+    stats[name] = {
+      'requests': requests,
+      'hits': int(hits[i]),
+      'misses': int(misses[i]),
+      'hit_ratio': hits[i] / requests,
+      'bytes_served': int(served[i]),
+      'bytes_fetched': int(fetched[i]),
+    }
+  return stats
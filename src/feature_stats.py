@@ -0,0 +1,134 @@
+import json
+import numpy as np
+from pathlib import Path
+from collections import Counter
+
+
+def _as_values(arr):
+  arr = np.asarray(arr).ravel()
+  if arr.dtype.kind in 'OSU':
+    return [v.decode('utf-8') if isinstance(v, bytes) else str(v) for v in arr]
+  return arr
+
+class FeatureStats:
+  """Per-column statistics for building preprocessing layers, mergeable.
+
+  Numeric columns keep (count, mean, M2), categorical columns keep value
+  counts. Batches are folded in with Chan's parallel update, so one pass
+  over the data covers every column, and statistics of different clients
+  merge on the server into exactly the statistics of the pooled data.
+  NaNs are skipped.
+  """
+  def __init__(self, numeric_cols=(), categorical_cols=()):
+    self.numeric = {col: [0, 0., 0.] for col in numeric_cols}
+    self.categorical = {col: Counter() for col in categorical_cols}
+
+  @staticmethod
+  def _merge_moments(a, count, mean, m2):
+    if count == 0:
+      return
+    total = a[0] + count
+    delta = mean - a[1]
+    a[1] += delta * count / total
+    a[2] += m2 + delta * delta * a[0] * count / total
+    a[0] = total
+
+  def update(self, batch):
+    """Fold a batch (dict of column arrays) into the statistics."""
+    for col, acc in self.numeric.items():
+      x = np.asarray(batch[col], dtype=np.float64).ravel()
+      x = x[~np.isnan(x)]
+      if len(x):
+        mean = x.mean()
+        self._merge_moments(acc, len(x), mean, float(np.dot(x - mean, x - mean)))
+    for col, counter in self.categorical.items():
+      values, counts = np.unique(np.asarray(batch[col]).ravel(), return_counts=True)
+      counter.update(dict(zip(_as_values(values), counts.tolist())))
+    return self
+
+  def merge(self, other):
+    """Add the statistics of another (disjoint) part of the data, in place."""
+    for col, acc in other.numeric.items():
+      self._merge_moments(self.numeric.setdefault(col, [0, 0., 0.]), *acc)
+    for col, counter in other.categorical.items():
+      self.categorical.setdefault(col, Counter()).update(counter)
+    return self
+
+  @classmethod
+  def merge_all(cls, stats_ls):
+    merged = cls()
+    for stats in stats_ls:
+      merged.merge(stats)
+    return merged
+
+  @classmethod
+  def from_dataset(cls, tfds, numeric_cols=(), categorical_cols=()):
+    """Statistics of a batched (features, labels) tf.data dataset, in one pass."""
+    stats = cls(numeric_cols, categorical_cols)
+    for x, _ in tfds.as_numpy_iterator():
+      stats.update(x)
+    return stats
+
+  @classmethod
+  def from_df(cls, df, numeric_cols=(), categorical_cols=()):
+    stats = cls(numeric_cols, categorical_cols)
+    return stats.update({col: df[col].to_numpy() for col in [*numeric_cols, *categorical_cols]})
+
+  def count(self, col):
+    return self.numeric[col][0]
+
+  def mean(self, col):
+    return self.numeric[col][1]
+
+  def variance(self, col):
+    """Population variance, as Normalization.adapt() computes it."""
+    count, _, m2 = self.numeric[col]
+    return m2 / count if count else 0.
+
+  def vocabulary(self, col, max_tokens=None, min_count=1):
+    """Values by descending frequency (ties by descending value), as the lookup layers order them."""
+    items = [(v, c) for v, c in self.categorical[col].items() if c >= min_count]
+    items.sort(key=lambda vc: (vc[1], vc[0]), reverse=True)
+    return [v for v, _ in items[:max_tokens]]
+
+  def to_dict(self):
+    return {
+      'numeric': {col: list(acc) for col, acc in self.numeric.items()},
+      'categorical': {
+        col: [[_to_builtin(v) for v in counter], list(counter.values())]
+        for col, counter in self.categorical.items()
+      },
+    }
+
+  @classmethod
+  def from_dict(cls, d):
+    stats = cls()
+    stats.numeric = {col: list(acc) for col, acc in d['numeric'].items()}
+    stats.categorical = {col: Counter(dict(zip(values, counts))) for col, (values, counts) in d['categorical'].items()}
+    return stats
+
+  def save(self, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(self.to_dict()))
+    return path
+
+  @classmethod
+  def load(cls, path):
+    return cls.from_dict(json.loads(Path(path).read_text()))
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: numeric: {list(self.numeric)}  categorical: {list(self.categorical)}>'
+
+
+def _to_builtin(v):
+  return v.item() if isinstance(v, np.generic) else v
+
+
+def local_feature_stats(tw, host, local_vars, numeric_cols=(), categorical_cols=()):
+  """Client task: statistics of local_vars['tfds_train'] into local_vars['feature_stats']."""
+  local_vars['feature_stats'] = FeatureStats.from_dataset(local_vars['tfds_train'], numeric_cols, categorical_cols)
+
+def collect_feature_stats(children):
+  """Server side merge of the children's local_vars['feature_stats']."""
+  return FeatureStats.merge_all(child.local_vars['feature_stats'] for child in children)
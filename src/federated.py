@@ -0,0 +1,284 @@
+import time
+import copy
+import numpy as np
+from src.emulator import UnitProcess
+from src.weight_transport import WeightLayout, WeightBuffer, close_buffers, open_weights
+from src.update_codecs import UpdateCodec, payload_nbytes, weights_nbytes
+
+
+def publish_update(local_vars, weights, global_weights):
+  """Hand a client's trained weights back to the server.
+
+  Encoded with local_vars['codec'] when the client has one, written into
+  the shared local_vars['update_slot'] when assigned, else left as
+  local_vars['weights']. local_vars['update_nbytes'] records the uplink
+  cost of the update.
+  """
+  codec = local_vars.get('codec')
+  if codec is not None:
+    payload = codec.encode(weights, reference=global_weights)
+    local_vars['update'] = payload
+    local_vars['update_nbytes'] = payload_nbytes(payload)
+    return
+
+  update_slot = local_vars.get('update_slot')
+  if update_slot is not None:
+    with WeightBuffer.attach(update_slot) as slot:
+      slot.pack(weights)
+  else:
+    local_vars['weights'] = weights
+  local_vars['update_nbytes'] = weights_nbytes(weights)
+
+
+def fit_local_model(tw, host, local_vars, global_weights, epochs=1, mu=0.):
+  """Default client task: k local epochs starting from the global weights.
+
+  Expects a compiled Keras model in local_vars['model'] and its training
+  dataset in local_vars['tfds_train']. The updated weights go through
+  publish_update() and the wall time is left in local_vars['train_time'].
+  `global_weights` may be a WeightBuffer handle.
+  """
+  with open_weights(global_weights) as global_weights:
+    _fit_local(local_vars, global_weights, epochs, mu)
+
+def _fit_local(local_vars, global_weights, epochs, mu):
+  # own frame, so nothing referencing the attached weights outlives the with block
+  model = local_vars['model']
+  model.set_weights(global_weights)
+
+  callbacks = []
+  if mu > 0:
+    from src.tf_utils import FedProxCallback
+    callbacks.append(FedProxCallback(global_weights, mu))
+
+  t_start = time.perf_counter()
+  model.fit(local_vars['tfds_train'], epochs=epochs, callbacks=callbacks, verbose=0)
+  local_vars['train_time'] = time.perf_counter() - t_start
+  publish_update(local_vars, model.get_weights(), global_weights)
+
+
+class WeightAggregator:
+  """Weighted average of weight lists into preallocated flat buffers.
+
+  All layers live in one contiguous accumulator with per-layer views, a
+  scratch buffer of the same layout holds the scaled client update, so a
+  round allocates nothing per client. Integer weights (e.g. counters of
+  preprocessing layers) are averaged in the float buffer and rounded back.
+  """
+  def __init__(self, template):
+    self.shapes = [np.shape(w) for w in template]
+    self.dtypes = [np.asarray(w).dtype for w in template]
+    floats = [d for d in self.dtypes if np.issubdtype(d, np.floating)]
+    self.dtype = np.result_type(*floats) if floats else np.dtype('float64')
+    self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+    self.offsets = np.concatenate([[0], np.cumsum(self.sizes)]).astype(np.int64)
+
+    self._acc = np.zeros(self.offsets[-1], dtype=self.dtype)
+    self._scratch = np.empty_like(self._acc)
+    self._acc_views = self._views(self._acc)
+    self._scratch_views = self._views(self._scratch)
+    self.total_weight = 0.
+
+  def _views(self, buf):
+    return [
+      buf[self.offsets[i]:self.offsets[i+1]].reshape(shape)
+      for i, shape in enumerate(self.shapes)
+    ]
+
+  def reset(self):
+    self._acc.fill(0)
+    self.total_weight = 0.
+
+  def add(self, weights, weight=1.):
+    for w, acc, scratch in zip(weights, self._acc_views, self._scratch_views):
+      np.multiply(w, weight, out=scratch, casting='unsafe')
+      np.add(acc, scratch, out=acc)
+    self.total_weight += weight
+
+  def result(self):
+    """Returns the averaged weights.
+
+    Float layers are views into the accumulator and are overwritten by
+    the next reset(), copy them if they have to outlive the round.
+    """
+    if self.total_weight > 0:
+      self._acc /= self.total_weight
+    out = []
+    for view, dtype in zip(self._acc_views, self.dtypes):
+      if view.dtype == dtype:
+        out.append(view)
+      elif np.issubdtype(dtype, np.integer):
+        out.append(np.rint(view).astype(dtype))
+      else:
+        out.append(view.astype(dtype))
+    return out
+
+
+class FedAvgScheduler:
+  """Round based FedAvg / FedProx on top of a UnitProcess tree.
+
+  The server node broadcasts the global weights, every sampled child runs
+  the client task for `local_epochs`, and the server averages the returned
+  weights by local_vars['num_samples']. Children are dispatched through
+  the server's exec_cfg, so rounds run sequentially or on a pool.
+
+  Args:
+      server: parent UnitProcess, its children are the clients
+      global_weights[optional]: initial weights, defaults to
+        server.local_vars['model'].get_weights()
+      local_epochs: local epochs per round
+      clients_per_round[optional]: clients sampled per round, all by default
+      mu: FedProx proximal coefficient, 0 gives plain FedAvg
+      straggler_timeout[optional]: updates whose local_vars['train_time']
+        (plus any simulated local_vars['latency']) exceeds this many
+        seconds are dropped from the round
+      seed[optional]: seed for client sampling
+      train_fn: client task, see fit_local_model for the contract
+      task_name: name the client task is registered under
+      transport[optional]: 'shm' or 'mmap' to exchange weights through
+        one shared flat buffer (broadcast) plus one slot per client
+        (updates) instead of pickling weight lists, useful with
+        exec_cfg mode 'process'. Call close() when done.
+      transport_path[optional]: file prefix for the 'mmap' transport
+      codec[optional]: UpdateCodec instance (copied per client) or codec
+        factory, client updates are compressed with it and the round
+        summary reports the uplink bytes
+  """
+  def __init__(
+      self,
+      server: UnitProcess,
+      global_weights=None,
+      local_epochs=1,
+      clients_per_round=None,
+      mu=0.,
+      straggler_timeout=None,
+      seed=None,
+      train_fn=fit_local_model,
+      task_name='fed_local_train',
+      transport=None,
+      transport_path='fed_weights',
+      codec=None,
+    ):
+    self.server = server
+    self.local_epochs = local_epochs
+    self.clients_per_round = clients_per_round
+    self.mu = mu
+    self.straggler_timeout = straggler_timeout
+    self.rng = np.random.default_rng(seed)
+    self.train_fn = train_fn
+    self.task_name = task_name
+    self.round = 0
+    self.history = []
+
+    if global_weights is None:
+      global_weights = server.local_vars['model'].get_weights()
+    self.global_weights = [np.array(w) for w in global_weights]
+    self.aggregator = WeightAggregator(self.global_weights)
+
+    for child in server.children:
+      if self.task_name not in child.task_queue:
+        child.create_task(self.task_name).set_task(self.train_fn)
+      if codec is not None:
+        child.local_vars['codec'] = copy.deepcopy(codec) if isinstance(codec, UpdateCodec) else codec()
+
+    self.broadcast = None
+    self.update_slots = []
+    if transport is not None:
+      self._init_transport(transport, transport_path)
+
+  def _init_transport(self, transport, transport_path):
+    layout = WeightLayout.from_weights(self.global_weights)
+    n = self.server.num_child
+    if transport == 'shm':
+      self.broadcast = WeightBuffer.create_shared(layout)
+      self.update_slots = WeightBuffer.create_shared(layout, count=n)
+    elif transport == 'mmap':
+      self.broadcast = WeightBuffer.create_memmap(layout, f'{transport_path}_global.bin')
+      self.update_slots = WeightBuffer.create_memmap(layout, f'{transport_path}_updates.bin', count=n)
+    else:
+      raise ValueError(f'unknown weight transport: {transport}')
+    for child, slot in zip(self.server.children, self.update_slots):
+      child.local_vars['update_slot'] = slot.handle()
+
+  def close(self):
+    if self.broadcast is None:
+      return
+    for child in self.server.children:
+      child.local_vars.pop('update_slot', None)
+    close_buffers([self.broadcast] + self.update_slots)
+    self.broadcast = None
+    self.update_slots = []
+
+  def sample_clients(self):
+    clients = self.server.children
+    k = self.clients_per_round
+    if k is None or k >= len(clients):
+      return list(clients)
+    idx = np.sort(self.rng.choice(len(clients), size=k, replace=False))
+    return [clients[i] for i in idx]
+
+  def run_round(self):
+    selected = self.sample_clients()
+    global_weights = self.global_weights
+    if self.broadcast is not None:
+      global_weights = self.broadcast.pack(self.global_weights).handle()
+    self.server.run_children_task(
+      self.task_name,
+      children=selected,
+      global_weights=global_weights,
+      epochs=self.local_epochs,
+      mu=self.mu,
+    )
+
+    accepted, dropped = [], []
+    for child in selected:
+      lv = child.local_vars
+      elapsed = lv.get('train_time', 0.) + lv.get('latency', 0.)
+      if self.straggler_timeout is not None and elapsed > self.straggler_timeout:
+        dropped.append(child)
+      else:
+        accepted.append(child)
+
+    # with no accepted update the global model is kept as is
+    uplink_bytes = 0
+    num_samples = 0.
+    if accepted:
+      self.aggregator.reset()
+      slots = dict(zip(map(id, self.server.children), self.update_slots))
+      for child in accepted:
+        lv = child.local_vars
+        if 'update' in lv:
+          weights = lv['codec'].decode(lv.pop('update'), reference=self.global_weights)
+          lv['codec'].commit()
+        elif id(child) in slots:
+          weights = slots[id(child)].unpack()
+        else:
+          weights = lv['weights']
+        self.aggregator.add(weights, lv.get('num_samples', 1))
+        uplink_bytes += lv.get('update_nbytes', 0)
+      # copied into the global buffer, which must not alias the accumulator
+      for dst, src in zip(self.global_weights, self.aggregator.result()):
+        np.copyto(dst, src, casting='unsafe')
+      num_samples = self.aggregator.total_weight
+      model = self.server.local_vars.get('model')
+      if model is not None:
+        model.set_weights(self.global_weights)
+
+    self.round += 1
+    summary = {
+      'round': self.round,
+      'clients': [c.name for c in accepted],
+      'dropped': [c.name for c in dropped],
+      'num_samples': num_samples,
+      'uplink_bytes': uplink_bytes,
+      'uplink_raw_bytes': len(accepted) * weights_nbytes(self.global_weights),
+    }
+    self.history.append(summary)
+    return summary
+
+  def run(self, rounds, callback=None):
+    for _ in range(rounds):
+      summary = self.run_round()
+      if callback is not None:
+        callback(self, summary)
+    return [np.array(w) for w in self.global_weights]
@@ -0,0 +1,172 @@
+import numpy as np
+from src.emulator import UnitProcess
+from src.sparse_mf import center_rows, als_statistics, solve_statistics, als_solve
+
+
+def assign_client_ratings(server: UnitProcess, mat, user_groups, names=None):
+  """Spawn one child per user group holding its rows of the rating matrix.
+
+  Args:
+      mat: global users x items CSR matrix
+      user_groups: list of user (row) index arrays, one per client
+      names[optional]: child names, defaults to 'Client [i]'
+  """
+  for i, users in enumerate(user_groups):
+    name = names[i] if names is not None else f'Client [{i:03}]'
+    child = server.spawn_child(name)
+    child.local_vars['user_ids'] = np.asarray(users)
+    child.local_vars['ratings'] = mat[np.asarray(users)]
+  return server
+
+
+def mf_local_step(tw, host, local_vars, item_factors, reg=0.1, mode='als', max_block_bytes=64 * 2**20):
+  """Client task of a federated MF round.
+
+  Re-solves the private user factors against the broadcast item factors
+  (exact ALS step, user factors never leave the client), then prepares the
+  item update for the touched items only: ALS sufficient statistics
+  (sum p p^T, sum p r, counts) in 'als' mode, or the squared loss gradient
+  in 'gradient' mode. The update is left in local_vars['mf_update'] and the
+  local squared error in local_vars['mf_sse'] / local_vars['mf_nnz'].
+  """
+  if 'ratings_centered' not in local_vars:
+    centered, means = center_rows(local_vars['ratings'].astype(np.float32))
+    local_vars['ratings_centered'] = centered
+    local_vars['ratings_centered_t'] = centered.T.tocsr()
+    local_vars['user_means'] = means
+  mat = local_vars['ratings_centered']
+  mat_t = local_vars['ratings_centered_t']
+
+  P = als_solve(mat, item_factors, reg, max_block_bytes)
+  local_vars['user_factors'] = P
+
+  rows = np.repeat(np.arange(mat.shape[0]), np.diff(mat.indptr))
+  err = np.einsum('ij,ij->i', P[rows], item_factors[mat.indices]) - mat.data
+  local_vars['mf_sse'] = float(np.dot(err, err))
+  local_vars['mf_nnz'] = mat.nnz
+
+  if mode == 'als':
+    items, gram, rhs, counts = als_statistics(mat_t, P, max_block_bytes)
+    local_vars['mf_update'] = {'items': items, 'gram': gram, 'rhs': rhs, 'counts': counts}
+  elif mode == 'gradient':
+    counts = np.diff(mat_t.indptr)
+    items = np.flatnonzero(counts)
+    grad = np.zeros_like(item_factors)
+    np.add.at(grad, mat.indices, err[:, None] * P[rows])
+    grad[items] += reg * counts[items, None] * item_factors[items]
+    local_vars['mf_update'] = {'items': items, 'grad': grad[items], 'counts': counts[items]}
+  else:
+    raise ValueError(f'unknown federated mf mode: {mode}')
+
+
+class FederatedMF:
+  """Federated matrix factorization with private user factors.
+
+  The server only holds the item factors Q. Every round it broadcasts Q,
+  the sampled children run `mf_local_step`, and the server sums their item
+  statistics into preallocated (items, k, k) / (items, k) buffers:
+
+  - 'als': summed Gram matrices are solved for the touched items, with all
+    clients sampled this is exactly centralized ALS
+  - 'gradient': summed gradients, normalized per item by its rating count,
+    are applied with step size `lr`
+
+  Children need local_vars['ratings'], a CSR matrix over the global item
+  ids (see assign_client_ratings). Dispatch follows the server's exec_cfg.
+  """
+  def __init__(
+      self,
+      server: UnitProcess,
+      n_items,
+      k=25,
+      reg=0.1,
+      mode='als',
+      lr=0.5,
+      clients_per_round=None,
+      seed=None,
+      task_name='fed_mf_local',
+    ):
+    if mode not in ('als', 'gradient'):
+      raise ValueError(f'unknown federated mf mode: {mode}')
+    self.server = server
+    self.k = k
+    self.reg = reg
+    self.mode = mode
+    self.lr = lr
+    self.clients_per_round = clients_per_round
+    self.task_name = task_name
+    self.rng = np.random.default_rng(seed)
+    self.round = 0
+    self.history = []
+
+    self.item_factors = self.rng.normal(scale=1. / np.sqrt(k), size=(n_items, k)).astype(np.float32)
+    if mode == 'als':
+      self._gram = np.zeros((n_items, k, k), dtype=np.float32)
+    self._rhs = np.zeros((n_items, k), dtype=np.float32)
+    self._counts = np.zeros(n_items, dtype=np.int64)
+
+    for child in server.children:
+      if task_name not in child.task_queue:
+        child.create_task(task_name).set_task(mf_local_step)
+
+  def sample_clients(self):
+    clients = self.server.children
+    k = self.clients_per_round
+    if k is None or k >= len(clients):
+      return list(clients)
+    idx = np.sort(self.rng.choice(len(clients), size=k, replace=False))
+    return [clients[i] for i in idx]
+
+  def run_round(self):
+    selected = self.sample_clients()
+    self.server.run_children_task(
+      self.task_name,
+      children=selected,
+      item_factors=self.item_factors,
+      reg=self.reg,
+      mode=self.mode,
+    )
+
+    self._rhs.fill(0)
+    self._counts.fill(0)
+    if self.mode == 'als':
+      self._gram.fill(0)
+
+    sse, nnz = 0., 0
+    for child in selected:
+      lv = child.local_vars
+      update = lv.pop('mf_update')
+      items = update['items']
+      # item ids are unique within one client update
+      if self.mode == 'als':
+        self._gram[items] += update['gram']
+        self._rhs[items] += update['rhs']
+      else:
+        self._rhs[items] += update['grad']
+      self._counts[items] += update['counts']
+      sse += lv['mf_sse']
+      nnz += lv['mf_nnz']
+
+    touched = np.flatnonzero(self._counts)
+    if self.mode == 'als':
+      self.item_factors[touched] = solve_statistics(
+        self._gram[touched], self._rhs[touched], self._counts[touched], self.reg)
+    else:
+      self.item_factors[touched] -= self.lr * self._rhs[touched] / self._counts[touched, None]
+
+    self.round += 1
+    summary = {
+      'round': self.round,
+      'clients': [c.name for c in selected],
+      'items_updated': len(touched),
+      'train_rmse': float(np.sqrt(sse / nnz)) if nnz else float('nan'),
+    }
+    self.history.append(summary)
+    return summary
+
+  def run(self, rounds, callback=None):
+    for _ in range(rounds):
+      summary = self.run_round()
+      if callback is not None:
+        callback(self, summary)
+    return self.item_factors
@@ -0,0 +1,107 @@
+_N_BUCKETS = 64
+
+
+class LatencyHistogram:
+  """Durations in ns, counted in power of two buckets.
+
+  Bucket b holds durations in [2**(b-1), 2**b), recording is a bit_length
+  and a list increment. Quantiles are read from the bucket bounds, so
+  they are exact to a factor of two, count/total/min/max are exact.
+  """
+  def __init__(self):
+    self.buckets = [0] * _N_BUCKETS
+    self.count = 0
+    self.total = 0
+    self.min = None
+    self.max = 0
+
+  def record(self, ns):
+    self.buckets[ns.bit_length()] += 1
+    self.count += 1
+    self.total += ns
+    if self.min is None or ns < self.min:
+      self.min = ns
+    if ns > self.max:
+      self.max = ns
+
+  def merge(self, other):
+    self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+    self.count += other.count
+    self.total += other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    self.max = max(self.max, other.max)
+    return self
+
+  def quantile(self, q):
+    """Upper bound of the bucket holding the q-quantile, clamped to [min, max]."""
+    if self.count == 0:
+      return None
+    rank = q * self.count
+    seen = 0
+    for b, n in enumerate(self.buckets):
+      seen += n
+      if n and seen >= rank:
+        return min(max(2 ** b - 1, self.min), self.max)
+    return self.max
+
+  def snapshot(self):
+    return {
+      'count': self.count,
+      'total_ns': self.total,
+      'mean_ns': self.total / self.count if self.count else None,
+      'min_ns': self.min,
+      'max_ns': self.max,
+      'p50_ns': self.quantile(.5),
+      'p99_ns': self.quantile(.99),
+      'buckets': {2 ** b - 1: n for b, n in enumerate(self.buckets) if n},
+    }
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: count: {self.count}  p50: {self.quantile(.5)}  max: {self.max}>'
+
+
+class NodeMetrics:
+  """Counters and per-task latency histograms of one node.
+
+  Counters are a plain dict, the cache counters are always present and
+  tasks may add their own names. Updates are not locked: in 'thread' mode
+  tasks of different threads updating the same node can lose increments.
+  """
+  COUNTERS = ('requests', 'hits', 'misses', 'evictions', 'bytes_served', 'bytes_fetched')
+
+  def __init__(self):
+    self.counters = dict.fromkeys(self.COUNTERS, 0)
+    self.latency = {}
+
+  def add(self, name, value=1):
+    self.counters[name] = self.counters.get(name, 0) + value
+
+  def observe(self, task_name, ns):
+    hist = self.latency.get(task_name)
+    if hist is None:
+      hist = self.latency[task_name] = LatencyHistogram()
+    hist.record(ns)
+
+  def merge(self, other):
+    for name, value in other.counters.items():
+      self.add(name, value)
+    for task_name, hist in other.latency.items():
+      self.latency.setdefault(task_name, LatencyHistogram()).merge(hist)
+    return self
+
+  def reset(self):
+    self.counters = dict.fromkeys(self.COUNTERS, 0)
+    self.latency = {}
+
+  def snapshot(self):
+    counters = dict(self.counters)
+    requests = counters['hits'] + counters['misses']
+    counters['hit_ratio'] = counters['hits'] / requests if requests else None
+    return {
+      'counters': counters,
+      'latency': {task_name: hist.snapshot() for task_name, hist in self.latency.items()},
+    }
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: {self.counters}  tasks: {list(self.latency)}>'
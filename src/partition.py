@@ -0,0 +1,173 @@
+import numpy as np
+
+
+class ClientPartition:
+  """Client assignment of n rows as an offsets + indices index.
+
+  `indices` lists the rows grouped by client (stable, so every client keeps
+  the original row order) and client i owns indices[offsets[i]:offsets[i+1]].
+  Indexing returns that slice as a view. split() gathers the data once into
+  client order, after that every client's data is a view as well.
+  """
+  def __init__(self, offsets, indices):
+    self.offsets = np.asarray(offsets, dtype=np.int64)
+    self.indices = np.asarray(indices, dtype=np.int64)
+
+  @classmethod
+  def from_assignment(cls, assignment, n_clients=None):
+    """Index from a client id per row, built with one counting pass and a stable sort."""
+    assignment = np.asarray(assignment)
+    if n_clients is None:
+      n_clients = int(assignment.max()) + 1 if assignment.size else 0
+    counts = np.bincount(assignment, minlength=n_clients)
+    if len(counts) > n_clients:
+      raise ValueError(f'assignment has client ids beyond n_clients={n_clients}')
+    offsets = np.zeros(n_clients + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    return cls(offsets, np.argsort(assignment, kind='stable'))
+
+  @property
+  def sizes(self):
+    return np.diff(self.offsets)
+
+  def assignment(self):
+    """Client id per row, the inverse of the index."""
+    out = np.empty(len(self.indices), dtype=np.int64)
+    out[self.indices] = np.repeat(np.arange(len(self)), self.sizes)
+    return out
+
+  def split(self, data):
+    """Per-client views of `data`, gathered into client order once.
+
+    Args:
+        data: array, DataFrame or dict of arrays with one entry per row
+
+    Returns:
+        list with one view (or dict of views) per client
+    """
+    if isinstance(data, dict):
+      ordered = {k: np.asarray(v)[self.indices] for k, v in data.items()}
+      return [{k: v[lo:hi] for k, v in ordered.items()} for lo, hi in self._bounds()]
+    if hasattr(data, 'iloc'):
+      ordered = data.take(self.indices)
+      return [ordered.iloc[lo:hi] for lo, hi in self._bounds()]
+    ordered = np.asarray(data)[self.indices]
+    return [ordered[lo:hi] for lo, hi in self._bounds()]
+
+  def _bounds(self):
+    return zip(self.offsets[:-1], self.offsets[1:])
+
+  def __getitem__(self, client):
+    return self.indices[self.offsets[client]:self.offsets[client + 1]]
+
+  def __iter__(self):
+    for lo, hi in self._bounds():
+      yield self.indices[lo:hi]
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def __repr__(self):
+    sizes = self.sizes
+    if not len(sizes):
+      return f'<{self.__class__.__name__}: 0 clients>'
+    return f'<{self.__class__.__name__}: {len(self)} clients  rows: {len(self.indices)}  size: {sizes.min()}-{sizes.max()}>'
+
+
+def iid_assignment(n_clients, rng, n=None, keys=None):
+  """Rows shuffled and dealt into clients of equal size (+-1)."""
+  if n is None:
+    n = len(keys)
+  assignment = np.empty(n, dtype=np.int64)
+  assignment[rng.permutation(n)] = np.arange(n) * n_clients // max(n, 1)
+  return assignment
+
+def key_assignment(n_clients, rng, keys):
+  """Every distinct key (user id, ...) goes to one client, keys are dealt at random."""
+  uniq, inverse = np.unique(np.asarray(keys), return_inverse=True)
+  return iid_assignment(n_clients, rng, n=len(uniq))[inverse]
+
+def key_range_assignment(n_clients, rng, keys):
+  """Sorted distinct keys cut into n_clients contiguous ranges.
+
+  Equivalent to np.array_split over the sorted unique keys, e.g. zip code
+  clusters where nearby codes share a prefix.
+  """
+  uniq, inverse = np.unique(np.asarray(keys), return_inverse=True)
+  return inverse.astype(np.int64) * n_clients // max(len(uniq), 1)
+
+def dirichlet_assignment(n_clients, rng, labels, alpha=0.5):
+  """Label skew: the rows of every label are split by proportions ~ Dir(alpha).
+
+  Small alpha gives clients that hold only a few labels, large alpha
+  approaches an iid split.
+  """
+  uniq, inverse = np.unique(np.asarray(labels), return_inverse=True)
+  n, n_labels = len(inverse), len(uniq)
+  # shuffled rows grouped by label, rank of each row within its label
+  order = rng.permutation(n)
+  order = order[np.argsort(inverse[order], kind='stable')]
+  label_counts = np.bincount(inverse, minlength=n_labels)
+  label_starts = np.concatenate([[0], np.cumsum(label_counts)[:-1]])
+  rank = np.arange(n) - label_starts[inverse[order]]
+
+  proportions = rng.dirichlet(np.full(n_clients, alpha), size=n_labels)
+  cuts = np.round(np.cumsum(proportions, axis=1) * label_counts[:, None]).astype(np.int64)
+  # one searchsorted over all labels, rows of label j are shifted by j * (n + 1)
+  shift = np.arange(n_labels, dtype=np.int64) * (n + 1)
+  flat_cuts = (cuts + shift[:, None]).ravel()
+  row_labels = inverse[order]
+  pos = np.searchsorted(flat_cuts, rank + shift[row_labels], side='right')
+  assignment = np.empty(n, dtype=np.int64)
+  assignment[order] = np.minimum(pos - row_labels * n_clients, n_clients - 1)
+  return assignment
+
+def kmeans_assignment(n_clients, rng, features, iterations=20):
+  """Clients are k-means clusters (Lloyd's algorithm) of the feature rows."""
+  x = np.asarray(features, dtype=np.float32)
+  if x.ndim == 1:
+    x = x[:, None]
+  centers = x[rng.choice(len(x), size=n_clients, replace=False)].copy()
+  sq_norms = np.einsum('ij,ij->i', x, x)
+  labels = None
+  for _ in range(iterations):
+    dist = sq_norms[:, None] - 2 * x @ centers.T + np.einsum('ij,ij->i', centers, centers)
+    new_labels = np.argmin(dist, axis=1)
+    if labels is not None and np.array_equal(labels, new_labels):
+      break
+    labels = new_labels
+    counts = np.bincount(labels, minlength=n_clients)
+    sums = np.zeros_like(centers)
+    np.add.at(sums, labels, x)
+    nonempty = counts > 0
+    centers[nonempty] = sums[nonempty] / counts[nonempty, None]
+  return labels.astype(np.int64)
+
+
+PARTITION_STRATEGIES = {
+  'iid': iid_assignment,
+  'by_key': key_assignment,
+  'by_user': key_assignment,
+  'by_key_range': key_range_assignment,
+  'by_zip_cluster': key_range_assignment,
+  'dirichlet': dirichlet_assignment,
+  'kmeans': kmeans_assignment,
+}
+
+def partition(strategy, n_clients, seed=None, **kwargs):
+  """Assign rows to clients in one vectorized pass.
+
+  Args:
+      strategy: name in PARTITION_STRATEGIES or a callable(n_clients, rng, **kwargs)
+      kwargs: strategy input, `n` or `keys` (iid), `keys` (by_user, by_zip_cluster),
+        `labels` and `alpha` (dirichlet), `features` (kmeans)
+
+  Returns:
+      ClientPartition
+  """
+  if isinstance(strategy, str):
+    if strategy not in PARTITION_STRATEGIES:
+      raise ValueError(f'unknown partition strategy: {strategy}, expected one of {list(PARTITION_STRATEGIES)}')
+    strategy = PARTITION_STRATEGIES[strategy]
+  assignment = strategy(n_clients, np.random.default_rng(seed), **kwargs)
+  return ClientPartition.from_assignment(assignment, n_clients)
@@ -1,5 +1,14 @@
+import os
+import json
+import hashlib
+import time
+import mmap
+import threading
 import requests
-from io import BytesIO
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
+from src.content_cache import ContentCache
 from pathlib import Path
 from urllib.request import url2pathname
 from urllib.parse import urlparse
@@ -29,40 +38,346 @@ def req_header(url, header=None, default_fallback_value=None):
     return resp.headers
   return resp.headers.get(header, default_fallback_value)
 
-def get_request(url, caching_enable=True, cache_folder='cache', params=None, chunk_size=1024*1024) -> BytesIO:
+_session = None
+_session_lock = threading.Lock()
 
-  cache_folder = Path(cache_folder).resolve()
-  cache_file = cache_folder / url_to_fp(url) 
+def get_session(pool_size=16):
+  """Shared requests.Session, connections are pooled across calls and range workers."""
+  global _session
+  with _session_lock:
+    if _session is None:
+      _session = requests.Session()
+      adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+      _session.mount('http://', adapter)
+      _session.mount('https://', adapter)
+  return _session
+
+
+class _RangeNotSatisfied(Exception):
+  pass
+
+class _Progress:
+  def __init__(self, total, done=0, steps=20):
+    self.total = total
+    self.done = done
+    self.steps = steps
+    self._shown = -1
+    self._lock = threading.Lock()
+
+  def update(self, n):
+    with self._lock:
+      self.done += n
+      if not self.total:
+        return
+      progress_frac = min(self.done / self.total, 1)
+      progress = int(progress_frac * self.steps)
+      if progress != self._shown:
+        self._shown = progress
+        print('progress: [',  ('='*progress).ljust(self.steps), f'] {progress_frac*100:.2f}%', sep='')
 
-  if caching_enable and cache_file.exists() and cache_file.is_file():
-    print(f'using cached file {relpath(cache_file)}')
-    buf = BytesIO(cache_file.read_bytes())
-  else:
-    print(f'downloading file to {relpath(cache_file)}')
 
-    content_length = int(req_header(url, 'Content-Length', 0))
-    print('file size:', content_length)
+def _probe(session, url, params):
+  resp = session.head(url, params=params, allow_redirects=True)
+  resp.raise_for_status()
+  headers = resp.headers
+  size = headers.get('Content-Length')
+  return {
+    'size': int(size) if size is not None and 'Content-Encoding' not in headers else None,
+    'ranges': headers.get('Accept-Ranges', '').lower() == 'bytes',
+    'validator': headers.get('ETag') or headers.get('Last-Modified'),
+    'etag': headers.get('ETag'),
+    'last_modified': headers.get('Last-Modified'),
+  }
+
+def _load_state(state_file, url, info):
+  try:
+    state = json.loads(Path(state_file).read_text())
+  except (OSError, ValueError):
+    return None
+  same = state.get('url') == url and state.get('size') == info['size'] and state.get('validator') == info['validator']
+  return state if same and info['validator'] is not None else None
+
+def _save_state(state_file, state):
+  tmp = Path(f'{state_file}.tmp')
+  tmp.write_text(json.dumps(state))
+  os.replace(tmp, state_file)
+
+def _fetch_whole(session, url, params, part, chunk_size, progress):
+  with session.get(url, params=params, stream=True) as resp:
+    resp.raise_for_status()
+    with open(part, 'wb') as f:
+      for chunk in resp.iter_content(chunk_size=chunk_size):
+        f.write(chunk)
+        progress.update(len(chunk))
 
-    resp = requests.get(url, params=params, stream=True)
+def _fetch_range(session, url, params, part, byte_range, validator, chunk_size, on_chunk):
+  lo, hi, done = byte_range
+  headers = {'Range': f'bytes={lo + done}-{hi - 1}'}
+  if validator is not None:
+    headers['If-Range'] = validator
+  with session.get(url, params=params, headers=headers, stream=True) as resp:
     resp.raise_for_status()
+    if resp.status_code != 206:
+      # range ignored, or the resource changed (If-Range mismatch)
+      raise _RangeNotSatisfied(url)
+    with open(part, 'r+b') as f:
+      f.seek(lo + done)
+      for chunk in resp.iter_content(chunk_size=chunk_size):
+        chunk = chunk[:hi - lo - byte_range[2]]
+        f.write(chunk)
+        f.flush()
+        byte_range[2] += len(chunk)
+        on_chunk(len(chunk))
+
+def file_sha256(path, chunk_size=1024*1024):
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def download_file(url, dest, params=None, workers=1, chunk_size=1024*1024, min_range_size=8*1024*1024,
+    sha256=None, retries=3, session=None) -> dict:
+  """Stream `url` to `dest` through a temp file, resumable and optionally parallel.
+
+  The body goes to `<dest>.part` and the bytes written per range are kept
+  in `<dest>.part.json`, so an interrupted download continues with HTTP
+  Range requests as long as the server reports the same size and
+  ETag/Last-Modified. With workers > 1 the file is fetched as parallel
+  byte ranges (at least min_range_size each) over the pooled session.
+  The sha256 is checked before the temp file is atomically renamed.
+
+  Returns:
+      the response metadata: size, etag, last_modified
+  """
+  dest = Path(dest)
+  dest.parent.mkdir(parents=True, exist_ok=True)
+  part = dest.with_name(dest.name + '.part')
+  state_file = dest.with_name(dest.name + '.part.json')
+  session = get_session() if session is None else session
+  info = _probe(session, url, params)
+  print('file size:', info['size'])
+
+  ranged = info['size'] is not None and info['ranges']
+  if ranged:
+    state = _load_state(state_file, url, info) if part.is_file() else None
+    if state is None:
+      n = max(1, min(workers, info['size'] // max(min_range_size, 1)))
+      bounds = [info['size'] * i // n for i in range(n + 1)]
+      state = {
+        'url': url,
+        'size': info['size'],
+        'validator': info['validator'],
+        'ranges': [[lo, hi, 0] for lo, hi in zip(bounds[:-1], bounds[1:])],
+      }
+      with open(part, 'wb') as f:
+        f.truncate(info['size'])
+    else:
+      print('resuming download')
+    pending = [r for r in state['ranges'] if r[0] + r[2] < r[1]]
+    progress = _Progress(info['size'], done=sum(r[2] for r in state['ranges']))
+    lock = threading.Lock()
+
+    def on_chunk(n):
+      progress.update(n)
+      with lock:
+        _save_state(state_file, state)
+
+    def fetch(byte_range):
+      for attempt in range(retries + 1):
+        try:
+          return _fetch_range(session, url, params, part, byte_range, info['validator'], chunk_size, on_chunk)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+          if attempt == retries:
+            raise
+
+    try:
+      if len(pending) > 1:
+        with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+          list(executor.map(fetch, pending))
+      else:
+        for byte_range in pending:
+          fetch(byte_range)
+    except _RangeNotSatisfied:
+      print('server did not honour the range request, downloading from the start')
+      ranged = False
+
+  if not ranged:
+    _fetch_whole(session, url, params, part, chunk_size, _Progress(info['size']))
+
+  if sha256 is not None and file_sha256(part) != sha256.lower():
+    part.unlink()
+    state_file.unlink(missing_ok=True)
+    raise ValueError(f'sha256 mismatch for {url}')
+  os.replace(part, dest)
+  state_file.unlink(missing_ok=True)
+  return {'size': dest.stat().st_size, 'etag': info['etag'], 'last_modified': info['last_modified']}
+
+class _MappedFile(mmap.mmap):
+  # read-only mmap with the file object methods zipfile looks for
+  def readable(self):
+    return True
+
+  def seekable(self):
+    return True
+
+  def writable(self):
+    return False
+
+
+class DownloadCache:
+  """Content-addressed cache for downloaded artifacts.
+
+  Blobs are stored once per sha256 under objects/, manifest.json maps every
+  url to its blob with the ETag, Last-Modified, size, sha256 and the times
+  of the last check and access. Entries older than `max_age` seconds (or
+  any entry with revalidate=True) are revalidated with a conditional
+  request, a 304 keeps the blob. Once the blobs exceed `max_bytes` the least
+  recently used ones are evicted. Hits are opened as read-only files or
+  mmaps, never read into memory.
+  """
+  manifest_name = 'manifest.json'
+
+  def __init__(self, folder='cache', max_bytes=None, max_age=None, session=None):
+    self.folder = Path(folder).resolve()
+    self.max_bytes = max_bytes
+    self.max_age = max_age
+    self.session = session
+    self.manifest = self._read_manifest()
+    self.lru = ContentCache(float('inf') if max_bytes is None else max_bytes, policy='lru')
+    evicted = []
+    for record in sorted(self.manifest.values(), key=lambda r: r['last_access']):
+      evicted += self.lru.put(record['sha256'], size=record['size'])
+    self._remove_blobs(evicted)
+
+  def _blob_path(self, sha256):
+    return self.folder / 'objects' / sha256[:2] / sha256
+
+  def _read_manifest(self):
+    try:
+      manifest = json.loads((self.folder / self.manifest_name).read_text())
+    except (OSError, ValueError):
+      return {}
+    return {key: r for key, r in manifest.items() if self._blob_path(r['sha256']).is_file()}
+
+  def _write_manifest(self):
+    self.folder.mkdir(parents=True, exist_ok=True)
+    tmp = self.folder / f'{self.manifest_name}.tmp'
+    tmp.write_text(json.dumps(self.manifest, indent=1))
+    os.replace(tmp, self.folder / self.manifest_name)
+
+  def _remove_blobs(self, shas):
+    shas = set(shas)
+    if not shas:
+      return
+    for sha256 in shas:
+      self.lru.pop(sha256)
+      self._blob_path(sha256).unlink(missing_ok=True)
+    self.manifest = {key: r for key, r in self.manifest.items() if r['sha256'] not in shas}
+    self._write_manifest()
+
+  def _touch(self, key, record):
+    record['last_access'] = time.time()
+    self.manifest[key] = record
+    self._write_manifest()
+    # the artifact being returned is never evicted by its own access
+    evicted = self.lru.put(record['sha256'], size=record['size'])
+    self._remove_blobs([sha256 for sha256 in evicted if sha256 != record['sha256']])
+
+  def _is_fresh(self, key, record):
+    headers = {}
+    if record.get('etag'):
+      headers['If-None-Match'] = record['etag']
+    if record.get('last_modified'):
+      headers['If-Modified-Since'] = record['last_modified']
+    if not headers:
+      return False
+    with self._session().get(key, headers=headers, stream=True) as resp:
+      if resp.status_code == 304:
+        return True
+      resp.raise_for_status()
+      return record.get('etag') is not None and resp.headers.get('ETag') == record['etag']
+
+  def _session(self):
+    return get_session() if self.session is None else self.session
+
+  def fetch(self, url, params=None, revalidate=False, workers=1, sha256=None, chunk_size=1024*1024) -> Path:
+    """Path of the cached blob for `url`, downloaded or revalidated as needed."""
+    key = requests.Request('GET', url, params=params).prepare().url
+    record = self.manifest.get(key)
+    if record is not None:
+      stale = revalidate or (self.max_age is not None and time.time() - record['checked'] > self.max_age)
+      if not stale or self._is_fresh(key, record):
+        if stale:
+          record['checked'] = time.time()
+        print(f'using cached file {relpath(self._blob_path(record["sha256"]))}')
+        self._touch(key, record)
+        return self._blob_path(record['sha256'])
+
+    # temp name derived from the url, so an interrupted download resumes
+    tmp = self.folder / 'tmp' / hashlib.sha1(key.encode()).hexdigest()
+    print(f'downloading file to {relpath(tmp)}')
+    info = download_file(key, tmp, workers=workers, chunk_size=chunk_size, session=self._session())
+    digest = file_sha256(tmp)
+    if sha256 is not None and digest != sha256.lower():
+      tmp.unlink()
+      raise ValueError(f'sha256 mismatch for {url}')
+    blob = self._blob_path(digest)
+    if blob.is_file():
+      tmp.unlink()
+    else:
+      blob.parent.mkdir(parents=True, exist_ok=True)
+      os.replace(tmp, blob)
+    now = time.time()
+    self._touch(key, {**info, 'url': url, 'sha256': digest, 'checked': now, 'last_access': now})
+    if record is not None and record['sha256'] != digest:
+      if all(r['sha256'] != record['sha256'] for r in self.manifest.values()):
+        self._remove_blobs([record['sha256']])
+    return blob
+
+  def open(self, url, use_mmap=False, **kwargs) -> BinaryIO:
+    """Cached artifact as a read-only file object, or an mmap with use_mmap=True."""
+    path = self.fetch(url, **kwargs)
+    if use_mmap and path.stat().st_size:
+      with open(path, 'rb') as f:
+        return _MappedFile(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return open(path, 'rb')
+
+  @property
+  def used(self):
+    return self.lru.used
+
+  def __contains__(self, url):
+    return url in self.manifest
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: {self.folder}  entries: {len(self.manifest)}  used: {self.used}>'
 
-    buf = BytesIO()
 
-    for chunk in resp.iter_content(chunk_size=chunk_size):
-      buf.write(chunk)
-      progress_frac = buf.getbuffer().nbytes / content_length
-      progress_frac = progress_frac if progress_frac < 1 else 1
-      
-      progress = int(progress_frac * 20)
-      print('progress: [',  ('='*progress).ljust(20), f'] {progress_frac*100:.2f}%', sep='')
+def get_request(url, caching_enable=True, cache_folder='cache', params=None, chunk_size=1024*1024,
+    workers=1, sha256=None, revalidate=False, max_bytes=None, use_mmap=False) -> BinaryIO:
+  """File object with the body of `url`.
 
-    resp.close()
-  
-  buf.seek(0)
+  With caching the artifact goes through a DownloadCache in `cache_folder`
+  (revalidated on request, capped at `max_bytes`). The body is never held
+  in memory, it is streamed to disk by download_file() (resumable, `workers`
+  parallel ranges, checked against `sha256`). Without caching the file goes
+  to a temp folder and is removed as soon as it is opened, where the OS
+  allows it.
+  """
   if caching_enable:
-    cache_file.parent.mkdir(parents=True, exist_ok=True)
-    cache_file.write_bytes(buf.read())
-    buf.seek(0)
+    cache = DownloadCache(cache_folder, max_bytes=max_bytes)
+    return cache.open(url, use_mmap=use_mmap, params=params, revalidate=revalidate, workers=workers,
+      sha256=sha256, chunk_size=chunk_size)
 
-  return buf
+  cache_file = Path(tempfile.mkdtemp()) / Path(url_to_fp(url)).name
+  print(f'downloading file to {cache_file}')
+  download_file(url, cache_file, params=params, workers=workers, chunk_size=chunk_size, sha256=sha256)
 
+  fp = open(cache_file, 'rb')
+  try:
+    cache_file.unlink()
+    cache_file.parent.rmdir()
+  except OSError:
+    pass
+  return fp
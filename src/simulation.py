@@ -0,0 +1,373 @@
+import heapq
+import numpy as np
+from src.content_cache import ContentCache
+from src.event_log import EventCode
+from src.emulator import UnitProcess, _assignment_to_index
+
+# Discrete-event timing for UnitProcess trees. Time is in seconds, sizes in
+# bytes and bandwidths in bytes per second. Links and stations are FIFO and
+# reserve their capacity when an event reaches them, which is exact as long
+# as events are handled in time order, what the Simulator heap guarantees.
+
+
+class Simulator:
+  """Heap event queue with a virtual clock.
+
+  Events are (time, seq, fn, args), ties run in scheduling order.
+  """
+  def __init__(self):
+    self.now = 0.
+    self.processed = 0
+    self._queue = []
+    self._seq = 0
+
+  def schedule_at(self, time, fn, *args):
+    self._seq += 1
+    heapq.heappush(self._queue, (time, self._seq, fn, args))
+
+  def schedule(self, delay, fn, *args):
+    self.schedule_at(self.now + delay, fn, *args)
+
+  def run(self, until=None):
+    """Process events in time order, up to `until` when given."""
+    queue = self._queue
+    pop = heapq.heappop
+    processed = 0
+    while queue:
+      if until is not None and queue[0][0] > until:
+        self.now = until
+        break
+      time, _, fn, args = pop(queue)
+      self.now = time
+      fn(*args)
+      processed += 1
+    self.processed += processed
+    return processed
+
+  def __len__(self):
+    return len(self._queue)
+
+
+class Link:
+  """One direction of a link: FIFO transmission at `bandwidth`, then `latency`.
+
+  Args:
+      latency[optional]: propagation delay
+      bandwidth[optional]: bytes per second, None for unlimited
+  """
+  def __init__(self, latency=0., bandwidth=None):
+    self.latency = latency
+    self.bandwidth = bandwidth
+    self.free_at = 0.
+    self.busy = 0.
+    self.bytes = 0
+    self.transfers = 0
+
+  def transmit(self, now, nbytes):
+    """Reserve the link for `nbytes` sent at `now`, returns the arrival time."""
+    duration = nbytes / self.bandwidth if self.bandwidth else 0.
+    start = now if now > self.free_at else self.free_at
+    self.free_at = start + duration
+    self.busy += duration
+    self.bytes += nbytes
+    self.transfers += 1
+    return self.free_at + self.latency
+
+  def utilization(self, horizon):
+    return self.busy / horizon if horizon > 0 else 0.
+
+
+class Station:
+  """Service of a node: `servers` parallel FIFO servers.
+
+  Args:
+      service_time[optional]: default time per job
+      servers[optional]: jobs served concurrently
+  """
+  def __init__(self, service_time=0., servers=1):
+    self.service_time = service_time
+    self.servers = servers
+    self.busy = 0.
+    self.wait = 0.
+    self.served = 0
+    self._free = [0.] * servers
+
+  def serve(self, now, service_time=None):
+    """Queue a job arriving at `now`, returns its completion time."""
+    service = self.service_time if service_time is None else service_time
+    free = heapq.heappop(self._free)
+    start = now if now > free else free
+    heapq.heappush(self._free, start + service)
+    self.busy += service
+    self.wait += start - now
+    self.served += 1
+    return start + service
+
+  def utilization(self, horizon):
+    return self.busy / (horizon * self.servers) if horizon > 0 else 0.
+
+
+class NetworkModel:
+  """Links and stations of a UnitProcess tree, keyed by node name.
+
+  Every node has an uplink towards its parent and a downlink from it, the
+  root's links lead to the origin (the content source) and model its
+  latency. Every node has a Station for its service time.
+
+  Args:
+      root: top node of the tree
+      latency, bandwidth[optional]: default link parameters
+      service_time, servers[optional]: default station parameters
+      links[optional]: dict node name -> (latency, bandwidth) overrides
+        for both directions of that node's link
+      stations[optional]: dict node name -> (service_time, servers)
+  """
+  def __init__(self, root: UnitProcess, latency=0., bandwidth=None, service_time=0., servers=1, links=None, stations=None):
+    links = links or {}
+    stations = stations or {}
+    self.root = root
+    self.up = {}
+    self.down = {}
+    self.stations = {}
+    nodes = [root]
+    while nodes:
+      node = nodes.pop()
+      link_latency, link_bandwidth = links.get(node.name, (latency, bandwidth))
+      self.up[node.name] = Link(link_latency, link_bandwidth)
+      self.down[node.name] = Link(link_latency, link_bandwidth)
+      self.stations[node.name] = Station(*stations.get(node.name, (service_time, servers)))
+      nodes.extend(node.children)
+
+  def path(self, node):
+    """Nodes from `node` up to the root."""
+    out = []
+    while node is not None:
+      out.append(node)
+      node = node.parent
+    return out
+
+  def report(self, horizon):
+    """Utilization, traffic and queueing over [0, horizon] per node."""
+    return {
+      name: {
+        'up_utilization': self.up[name].utilization(horizon),
+        'down_utilization': self.down[name].utilization(horizon),
+        'bytes_up': self.up[name].bytes,
+        'bytes_down': self.down[name].bytes,
+        'station_utilization': station.utilization(horizon),
+        'mean_wait': station.wait / station.served if station.served else 0.,
+      }
+      for name, station in self.stations.items()
+    }
+
+
+def _latency_stats(latency):
+  if not len(latency):
+    return {'count': 0}
+  p50, p99 = np.percentile(latency, [50, 99])
+  return {
+    'count': len(latency),
+    'mean': float(latency.mean()),
+    'p50': float(p50),
+    'p99': float(p99),
+    'max': float(latency.max()),
+  }
+
+def simulate_requests(root, network: NetworkModel, user_ids, object_ids, assignment, timestamps,
+    sizes=1, request_bytes=0, clients=None, time_scale=1., sim=None, event_log=None):
+  """Timed replay of a request trace through a cache hierarchy.
+
+  A request arrives at its client at its timestamp, waits for the
+  client's station, then hits its cache or is sent up the client's
+  uplink to the parent, and so on up to the origin behind the root. The
+  object then travels back down the same path, through every downlink's
+  FIFO queue. Caches of `local_vars['cache']` are updated in place when a
+  request reaches them. The hit/miss decisions equal replay_trace()'s
+  only when all paths to a shared parent take the same time: otherwise
+  queueing and link delays can reorder the arrivals at that parent.
+
+  Args:
+      network: NetworkModel of the tree
+      timestamps: request arrival times, e.g. the rating timestamps
+      sizes[optional]: scalar size, or array indexed by object id
+      request_bytes[optional]: size of a request message going up
+      clients[optional]: client nodes indexed by the assignment,
+        defaults to root.children
+      time_scale[optional]: factor applied to the timestamps (relative to
+        the first one) to replay a trace faster or slower
+      sim[optional]: Simulator to schedule on, e.g. shared with rounds
+      event_log[optional]: EventLog receiving a CACHE_HIT or CACHE_MISS
+        event per request and node, stamped with the simulated time in ns
+
+  Returns:
+      dict with 'latency' (count, mean, p50, p99, max), 'served_by' (hits
+      per tree level, 0 = client, last = origin for clients at any
+      depth), 'makespan', 'events'
+      and the per node 'network' report
+  """
+  user_ids = np.asarray(user_ids)
+  object_ids = np.asarray(object_ids)
+  timestamps = np.asarray(timestamps, dtype=np.float64)
+  order = np.argsort(timestamps, kind='stable')
+  user_ids, object_ids, timestamps = user_ids[order], object_ids[order], timestamps[order]
+  if len(timestamps):
+    timestamps = (timestamps - timestamps[0]) * time_scale
+  req_sizes = np.full(len(object_ids), sizes) if np.ndim(sizes) == 0 else np.asarray(sizes)[object_ids]
+
+  if clients is None:
+    clients = root.children
+  client_idx = _assignment_to_index(user_ids, assignment, len(clients))
+  paths = [network.path(client) for client in clients]
+  ups = [[network.up[node.name] for node in path] for path in paths]
+  downs = [[network.down[node.name] for node in path] for path in paths]
+  stations = [[network.stations[node.name] for node in path] for path in paths]
+  caches = [[node.local_vars.get('cache') for node in path] for path in paths]
+  node_ids = [[event_log.node_id(node.name, owner=node) for node in path] for path in paths] if event_log is not None else None
+  # origin hits go to the last bin whatever the client's depth
+  depth = max((len(p) for p in paths), default=0)
+
+  sim = Simulator() if sim is None else sim
+  start = sim.now
+  n = len(object_ids)
+  finish = np.zeros(n)
+  served_by = np.zeros(n, dtype=np.int64)
+  keys = object_ids.tolist()
+  key_sizes = req_sizes.tolist()
+  schedule_at = sim.schedule_at
+
+  def arrive(r, c, level):
+    schedule_at(stations[c][level].serve(sim.now), lookup, r, c, level)
+
+  def lookup(r, c, level):
+    cache = caches[c][level]
+    hit = cache.access(keys[r], size=key_sizes[r]) if isinstance(cache, ContentCache) else False
+    if event_log is not None:
+      code = EventCode.CACHE_HIT if hit else EventCode.CACHE_MISS
+      event_log.record(code, node_ids[c][level], keys[r], key_sizes[r], int(sim.now * 1e9))
+    if hit:
+      serve_from(r, c, level)
+    elif level + 1 < len(paths[c]):
+      schedule_at(ups[c][level].transmit(sim.now, request_bytes), arrive, r, c, level + 1)
+    else:
+      # origin, behind the root's link
+      schedule_at(ups[c][level].transmit(sim.now, request_bytes), serve_from, r, c, level + 1)
+
+  def serve_from(r, c, level):
+    served_by[r] = level if level < len(paths[c]) else depth
+    send_down(r, c, level)
+
+  def send_down(r, c, level):
+    if level == 0:
+      finish[r] = sim.now
+      return
+    schedule_at(downs[c][level - 1].transmit(sim.now, key_sizes[r]), send_down, r, c, level - 1)
+
+  def next_arrival(r):
+    # arrivals are chained, the queue only holds requests in flight
+    arrive(r, client_idx[r], 0)
+    if r + 1 < n:
+      schedule_at(start + arrival_times[r + 1], next_arrival, r + 1)
+
+  client_idx = client_idx.tolist()
+  arrival_times = timestamps.tolist()
+  if n:
+    schedule_at(start + arrival_times[0], next_arrival, 0)
+  events = sim.run()
+
+  latency = finish - (start + timestamps)
+  makespan = (finish.max() - start) if n else 0.
+  return {
+    'latency': _latency_stats(latency),
+    'served_by': np.bincount(served_by, minlength=depth + 1).tolist(),
+    'makespan': makespan,
+    'events': events,
+    'network': network.report(sim.now - start),
+  }
+
+
+def simulate_rounds(server, network: NetworkModel, model_bytes, rounds=1, clients=None,
+    update_bytes=None, train_time=0., sim=None):
+  """Timing of synchronous federated rounds over the tree.
+
+  Every round the server sends the model down to each client (one copy
+  per client, hop by hop through the FIFO downlinks), the client trains
+  on its station, sends its update back up, and the server's station
+  aggregates it. A round completes with the last aggregated update and
+  the next one starts right after.
+
+  Args:
+      server: node holding the global model, an ancestor of the clients
+      network: NetworkModel of the tree
+      model_bytes: size of the broadcast model
+      clients[optional]: participating nodes, defaults to server.children
+      update_bytes[optional]: size of an update, defaults to model_bytes
+      train_time[optional]: scalar, array per client or dict of client
+        name -> local training time
+
+  Returns:
+      dict with 'round_time' (per round), 'update_latency' (from round
+      start to the aggregation of each update, all rounds), 'completion',
+      'events' processed by this call and the per node 'network' report
+  """
+  clients = server.children if clients is None else list(clients)
+  update_bytes = model_bytes if update_bytes is None else update_bytes
+  if isinstance(train_time, dict):
+    train_time = [train_time[client.name] for client in clients]
+  train_time = np.broadcast_to(np.asarray(train_time, dtype=np.float64), (len(clients),)).tolist()
+
+  paths = []
+  for client in clients:
+    path = network.path(client)
+    if server not in path:
+      raise ValueError(f'{client.name} is not below {server.name}')
+    paths.append(path[:path.index(server)])
+  downs = [[network.down[node.name] for node in path] for path in paths]
+  ups = [[network.up[node.name] for node in path] for path in paths]
+  client_stations = [network.stations[client.name] for client in clients]
+  server_station = network.stations[server.name]
+
+  sim = Simulator() if sim is None else sim
+  start = sim.now
+  round_times = []
+  update_latency = []
+  state = {'pending': 0, 'round_start': 0.}
+
+  def send_down(c, hop):
+    # hop counts down from the server side, hop -1 is the client itself
+    if hop < 0:
+      sim.schedule_at(client_stations[c].serve(sim.now, train_time[c]), send_up, c, 0)
+      return
+    sim.schedule_at(downs[c][hop].transmit(sim.now, model_bytes), send_down, c, hop - 1)
+
+  def send_up(c, hop):
+    if hop == len(ups[c]):
+      sim.schedule_at(server_station.serve(sim.now), aggregate)
+      return
+    sim.schedule_at(ups[c][hop].transmit(sim.now, update_bytes), send_up, c, hop + 1)
+
+  def aggregate():
+    update_latency.append(sim.now - state['round_start'])
+    state['pending'] -= 1
+    if state['pending'] == 0:
+      round_times.append(sim.now - state['round_start'])
+      if len(round_times) < rounds:
+        begin_round()
+
+  def begin_round():
+    state['round_start'] = sim.now
+    state['pending'] = len(clients)
+    for c in range(len(clients)):
+      send_down(c, len(downs[c]) - 1)
+
+  events = 0
+  if clients and rounds > 0:
+    sim.schedule_at(start, begin_round)
+    events = sim.run()
+
+  return {
+    'round_time': round_times,
+    'update_latency': _latency_stats(np.asarray(update_latency)),
+    'completion': sim.now - start,
+    'events': events,
+    'network': network.report(sim.now - start),
+  }
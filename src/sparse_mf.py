@@ -0,0 +1,165 @@
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.linalg import svds as scipy_svds
+
+
+def ratings_to_csr(user_ids, item_ids, ratings, shape=None, dtype=np.float32):
+  """Build a users x items CSR matrix straight from integer ids.
+
+  Replaces `df.pivot(...).fillna(0).values`, only the observed ratings are
+  stored. Ids are used as row/column indices, so they should be zero based
+  and contiguous (see the loaders' remapped ids). Duplicate (user, item)
+  pairs are summed.
+  """
+  rows = np.asarray(user_ids).astype(np.int32, copy=False)
+  cols = np.asarray(item_ids).astype(np.int32, copy=False)
+  vals = np.asarray(ratings, dtype=dtype)
+  if shape is None:
+    shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+  mat = csr_matrix((vals, (rows, cols)), shape=shape, dtype=dtype)
+  mat.sum_duplicates()
+  return mat
+
+def df_to_csr(df, U_c, V_c, val_c, shape=None):
+  return ratings_to_csr(df[U_c].to_numpy(), df[V_c].to_numpy(), df[val_c].to_numpy(), shape=shape)
+
+def row_means(mat):
+  """Mean over the observed entries of every row, 0 for empty rows."""
+  counts = np.diff(mat.indptr)
+  sums = np.asarray(mat.sum(axis=1)).ravel()
+  return np.divide(sums, counts, out=np.zeros_like(sums, dtype=np.float32), where=counts > 0).astype(np.float32)
+
+def center_rows(mat):
+  """Subtract the row means from the observed entries only, stays sparse."""
+  means = row_means(mat)
+  centered = mat.copy()
+  centered.data -= np.repeat(means, np.diff(mat.indptr))
+  return centered, means
+
+
+def svd_factorize(mat, k=25, center=True):
+  """Truncated SVD on the sparse matrix.
+
+  Returns:
+      (P, Q, means): user factors U * sigma, item factors Vt.T and the
+      row means that were removed (None when center=False)
+  """
+  means = None
+  if center:
+    mat, means = center_rows(mat)
+  U, sigma, Vt = scipy_svds(mat, k=k)
+  return (U * sigma).astype(np.float32), Vt.T.astype(np.float32), means
+
+
+def _iter_gram_blocks(mat, fixed, max_block_bytes):
+  """Per-row Gram matrices F^T F and F^T r of `mat` against `fixed`.
+
+  Rows are handled in blocks: per-rating outer products are reduced to the
+  per-row sums with np.add.reduceat, the block size is bounded by
+  max_block_bytes. Yields (rows, gram, rhs, counts) for non-empty rows.
+  """
+  n_rows = mat.shape[0]
+  k = fixed.shape[1]
+  indptr, indices, data = mat.indptr, mat.indices, mat.data
+  counts = np.diff(indptr)
+  budget = max(1, max_block_bytes // (k * k * 4))
+  start = 0
+  while start < n_rows:
+    # grow the block until its nnz would exceed the budget
+    stop = int(np.searchsorted(indptr, indptr[start] + budget, side='right')) - 1
+    stop = min(max(stop, start + 1), n_rows)
+    lo, hi = indptr[start], indptr[stop]
+    if hi > lo:
+      nonempty = counts[start:stop] > 0
+      F = fixed[indices[lo:hi]]
+      seg = (indptr[start:stop] - lo)[nonempty]
+      gram = np.add.reduceat(F[:, :, None] * F[:, None, :], seg, axis=0)
+      rhs = np.add.reduceat(F * data[lo:hi, None], seg, axis=0)
+      rows = np.arange(start, stop)[nonempty]
+      yield rows, gram, rhs, counts[rows]
+    start = stop
+
+def als_statistics(mat, fixed, max_block_bytes=64 * 2**20):
+  """ALS sufficient statistics of every non-empty row, concatenated."""
+  parts = list(_iter_gram_blocks(mat, fixed, max_block_bytes))
+  k = fixed.shape[1]
+  if not parts:
+    return (np.zeros(0, dtype=np.int64), np.zeros((0, k, k), dtype=np.float32),
+      np.zeros((0, k), dtype=np.float32), np.zeros(0, dtype=np.int64))
+  return tuple(np.concatenate(p) for p in zip(*parts))
+
+def solve_statistics(gram, rhs, counts, reg):
+  """Weighted-lambda regularized solve of stacked normal equations."""
+  k = gram.shape[-1]
+  gram = gram + reg * np.eye(k, dtype=gram.dtype) * counts[:, None, None]
+  return np.linalg.solve(gram, rhs[..., None])[..., 0]
+
+def als_solve(mat, fixed, reg, max_block_bytes=64 * 2**20):
+  """One ALS half-step: solve every row of `mat` against the fixed factors."""
+  out = np.zeros((mat.shape[0], fixed.shape[1]), dtype=np.float32)
+  for rows, gram, rhs, counts in _iter_gram_blocks(mat, fixed, max_block_bytes):
+    out[rows] = solve_statistics(gram, rhs, counts, reg)
+  return out
+
+def als_factorize(mat, k=25, reg=0.1, iterations=10, center=True, seed=None, max_block_bytes=64 * 2**20):
+  """Alternating least squares over the observed entries only.
+
+  Uses weighted-lambda regularization (reg scaled by the number of ratings
+  per row/column). Memory stays at O(nnz + (users + items) * k) plus one
+  block of Gram matrices bounded by max_block_bytes.
+
+  Returns:
+      (P, Q, means) like svd_factorize()
+  """
+  means = None
+  if center:
+    mat, means = center_rows(mat)
+  mat = mat.astype(np.float32)
+  mat_t = mat.T.tocsr()
+
+  rng = np.random.default_rng(seed)
+  Q = rng.normal(scale=1. / np.sqrt(k), size=(mat.shape[1], k)).astype(np.float32)
+  P = np.zeros((mat.shape[0], k), dtype=np.float32)
+  for _ in range(iterations):
+    P = als_solve(mat, Q, reg, max_block_bytes)
+    Q = als_solve(mat_t, P, reg, max_block_bytes)
+  return P, Q, means
+
+
+def predict_observed(mat, P, Q, means=None, chunk_size=2**20):
+  """Predictions at the observed positions of `mat`, in mat.data order."""
+  rows = np.repeat(np.arange(mat.shape[0], dtype=np.int32), np.diff(mat.indptr))
+  cols = mat.indices
+  pred = np.empty(mat.nnz, dtype=np.float32)
+  for lo in range(0, mat.nnz, chunk_size):
+    hi = min(lo + chunk_size, mat.nnz)
+    pred[lo:hi] = np.einsum('ij,ij->i', P[rows[lo:hi]], Q[cols[lo:hi]])
+  if means is not None:
+    pred += means[rows]
+  return pred
+
+def rmse_observed(mat, P, Q, means=None):
+  """RMSE over the observed ratings only, no dense prediction matrix."""
+  err = predict_observed(mat, P, Q, means) - mat.data
+  return float(np.sqrt(np.mean(err.astype(np.float64) ** 2)))
+
+def top_n(P, Q, users, n=10, exclude=None, batch_size=1024):
+  """Top-n item indices per user, scored a batch of users at a time.
+
+  Args:
+      users: user (row) indices to score
+      exclude[optional]: CSR matrix of already rated items to skip
+  """
+  users = np.atleast_1d(np.asarray(users))
+  n = min(n, Q.shape[0])
+  out = np.empty((len(users), n), dtype=np.int64)
+  for lo in range(0, len(users), batch_size):
+    batch = users[lo:lo + batch_size]
+    scores = P[batch] @ Q.T
+    if exclude is not None:
+      seen = exclude[batch]
+      scores[np.repeat(np.arange(len(batch)), np.diff(seen.indptr)), seen.indices] = -np.inf
+    part = np.argpartition(-scores, n - 1, axis=1)[:, :n]
+    order = np.argsort(-np.take_along_axis(scores, part, axis=1), axis=1)
+    out[lo:lo + len(batch)] = np.take_along_axis(part, order, axis=1)
+  return out
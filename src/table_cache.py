@@ -0,0 +1,92 @@
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from src.request_utils import file_sha256
+
+# Columnar on-disk cache for parsed tables: one .npy per column, numeric
+# columns are memory-mapped on load, string-like columns are stored as
+# int32 codes plus a fixed-width unicode category array (no pickling).
+
+_META_FILE = 'meta.json'
+
+
+def _fn_fingerprint(fn):
+  code = getattr(fn, '__code__', None)
+  if code is None:
+    return repr(fn)
+  return hashlib.sha1(code.co_code + repr(code.co_consts).encode()).hexdigest()
+
+def table_cache_key(spec, source_paths, converters=None):
+  """Key for a set of parsed tables.
+
+  Combines the loader spec (anything json serializable), the sha256 of
+  every source file (the archive, or the extracted members) and the
+  bytecode of the converters, so editing either the data or the parsing
+  code invalidates the cache.
+  """
+  sources = [[Path(path).name, file_sha256(path)] for path in source_paths]
+  converters = converters or {}
+  payload = {
+    'spec': spec,
+    'sources': sources,
+    'converters': {
+      tb: {col: _fn_fingerprint(fn) for col, fn in sorted(cols.items())}
+      for tb, cols in sorted(converters.items())
+    },
+  }
+  return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def _save_column(folder, idx, series):
+  dtype = series.dtype
+  if isinstance(dtype, pd.CategoricalDtype):
+    codes = series.cat.codes.to_numpy()
+    categories = series.cat.categories.to_numpy()
+    kind = 'category'
+  elif (pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype)) \
+      and not pd.api.types.is_extension_array_dtype(dtype):
+    np.save(folder / f'{idx}.npy', series.to_numpy())
+    return {'name': series.name, 'kind': 'numeric', 'dtype': str(dtype)}
+  else:
+    codes, categories = pd.factorize(series, use_na_sentinel=True)
+    categories = np.asarray(categories)
+    kind = 'factorized'
+  np.save(folder / f'{idx}.npy', codes.astype(np.int32))
+  np.save(folder / f'{idx}.categories.npy', categories.astype(str) if categories.dtype == object else categories)
+  return {'name': series.name, 'kind': kind, 'dtype': str(dtype)}
+
+def _load_column(folder, idx, col):
+  if col['kind'] == 'numeric':
+    return np.load(folder / f'{idx}.npy', mmap_mode='c')
+  codes = np.load(folder / f'{idx}.npy')
+  categories = np.load(folder / f'{idx}.categories.npy')
+  values = pd.Series(pd.Categorical.from_codes(codes, categories=categories))
+  if col['kind'] == 'category':
+    return values
+  return values.astype(col['dtype'])
+
+
+def save_tables(cache_dir, tables):
+  """Write a dict of DataFrames, the meta file is written last as commit marker."""
+  cache_dir = Path(cache_dir)
+  meta = {}
+  for tb_name, df in tables.items():
+    folder = cache_dir / tb_name
+    folder.mkdir(parents=True, exist_ok=True)
+    meta[tb_name] = [_save_column(folder, i, df[c]) for i, c in enumerate(df.columns)]
+  (cache_dir / _META_FILE).write_text(json.dumps(meta))
+
+def load_tables(cache_dir):
+  """Read tables written by save_tables, returns None when not cached."""
+  cache_dir = Path(cache_dir)
+  meta_file = cache_dir / _META_FILE
+  if not meta_file.is_file():
+    return None
+  tables = {}
+  for tb_name, cols in json.loads(meta_file.read_text()).items():
+    folder = cache_dir / tb_name
+    data = {col['name']: _load_column(folder, i, col) for i, col in enumerate(cols)}
+    tables[tb_name] = pd.DataFrame(data, copy=False)
+  return tables
@@ -26,6 +26,25 @@ def gen_multihot_categorical_encoding_layer(tfds, col_name, type_enum: TypeEnum,
   
   return lambda f: encoder(indexer(f))
 
+def normalization_layer_from_stats(stats, col_name, axis=None):
+  """Normalization layer from precomputed FeatureStats, no adapt() pass."""
+  return tf.keras.layers.Normalization(axis=axis, mean=stats.mean(col_name), variance=stats.variance(col_name))
+
+def multihot_categorical_encoding_layer_from_stats(stats, col_name, type_enum: TypeEnum, max_tokens=None):
+  """Lookup -> CategoryEncoding from precomputed FeatureStats, no adapt() pass."""
+  # max_tokens counts the OOV token, like adapt() does
+  vocabulary = stats.vocabulary(col_name, max_tokens=None if max_tokens is None else max_tokens - 1)
+  if type_enum == TypeEnum.string:
+    indexer = tf.keras.layers.StringLookup(vocabulary=vocabulary)
+  elif type_enum == TypeEnum.integer:
+    indexer = tf.keras.layers.IntegerLookup(vocabulary=np.asarray(vocabulary, dtype=np.int64))
+  else:
+    raise NameError(f'type_enum is invalid {type_enum}')
+
+  encoder = tf.keras.layers.CategoryEncoding(num_tokens=indexer.vocabulary_size())
+
+  return lambda f: encoder(indexer(f))
+
 def gen_string_lookup(tfds, col_name, vocabulary=None, max_tokens=None):
   features = tfds.map(lambda x, _: x[col_name])
   indexer = tf.keras.layers.StringLookup(max_tokens=max_tokens, vocabulary=vocabulary)
@@ -1,47 +1,247 @@
 import tensorflow as tf
+import numpy as np
+import pandas as pd
 import csv
 from io import StringIO
 
-def df_to_tfds(df, label_col_name, shuffle=True, batch_size=32):
-  """Convert pandas dataframe into tensorflow dataset
+def df_to_arrays(df, label_col_name=None):
+  """Columns of a dataframe as contiguous typed (n, 1) arrays.
+
+  Floats become float32, integers and booleans keep their dtype, anything
+  else (strings, categories) becomes an object array of str, which
+  TensorFlow reads as tf.string.
+
+  Returns:
+      (features, labels): dict of arrays, and the label column (None when
+      label_col_name is None), never part of the features
+  """
+  features = {}
+  labels = None
+  for col in df.columns:
+    values = df[col]
+    dtype = values.dtype
+    if pd.api.types.is_float_dtype(dtype):
+      arr = values.to_numpy(dtype=np.float32)
+    elif (pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype)) \
+        and not pd.api.types.is_extension_array_dtype(dtype):
+      arr = values.to_numpy()
+    else:
+      arr = values.astype(str).to_numpy(dtype=object)
+    arr = np.ascontiguousarray(arr)
+    if col == label_col_name:
+      labels = arr
+    else:
+      features[col] = arr[:, np.newaxis]
+  return features, labels
+
+
+class DatasetBuilder:
+  """Builds tf.data pipelines over columns converted once.
+
+  The dataframe is turned into typed arrays and tensors a single time,
+  `preprocess` (a vectorized function over the whole feature dict) is
+  applied once as well. Every pipeline then only streams row indices:
+  indices are shuffled, batched, and each batch is gathered from the
+  shared tensors, so any number of per-client datasets reuse the same
+  memory.
 
   Args:
+      df: source dataframe
+      label_col_name: label column, excluded from the features
+      preprocess[optional]: callable(features dict) -> features dict
   """
-  c_df = df.copy()
-  labels = c_df.pop(label_col_name)
-  c_df = {key: value[:,tf.newaxis] for key, value in df.items()}
+  def __init__(self, df, label_col_name, preprocess=None):
+    features, labels = df_to_arrays(df, label_col_name)
+    if preprocess is not None:
+      features = preprocess(features)
+    self.n = len(df)
+    self.features = {k: tf.convert_to_tensor(v) for k, v in features.items()}
+    self.labels = tf.convert_to_tensor(labels)
+
+  def _gather(self, idx):
+    return {k: tf.gather(v, idx) for k, v in self.features.items()}, tf.gather(self.labels, idx)
+
+  def dataset(self, indices=None, shuffle=True, batch_size=32, seed=None, cache=None):
+    """Batched dataset over `indices` (all rows when None).
 
-  tfds = tf.data.Dataset.from_tensor_slices((dict(c_df), labels))
+    Args:
+        cache[optional]: cache the gathered batches, defaults to True for
+          unshuffled datasets, whose batches are the same every epoch
+    """
+    if indices is None:
+      indices = np.arange(self.n)
+    indices = np.asarray(indices, dtype=np.int64)
+    tfds = tf.data.Dataset.from_tensor_slices(indices)
+    if shuffle:
+      tfds = tfds.shuffle(buffer_size=max(len(indices), 1), seed=seed, reshuffle_each_iteration=True)
+    tfds = tfds.batch(batch_size)
+    tfds = tfds.map(self._gather, num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle)
+    use_cache = (not shuffle) if cache is None else cache
+    if use_cache:
+      tfds = tfds.cache()
+    return tfds.prefetch(tf.data.AUTOTUNE)
 
-  if shuffle:
-    tfds = tfds.shuffle(buffer_size=len(df))
+  def client_datasets(self, groups, **kwargs):
+    """One dataset per index array, e.g. the clients of a ClientPartition."""
+    return [self.dataset(indices, **kwargs) for indices in groups]
 
-  tfds = tfds.batch(batch_size)
-  tfds = tfds.prefetch(batch_size)
-  return tfds
+
+def df_to_tfds(df, label_col_name, shuffle=True, batch_size=32, seed=None):
+  """Convert pandas dataframe into tensorflow dataset
+
+  Args:
+      df: source dataframe, the label column is not used as a feature
+      label_col_name: label column
+  """
+  return DatasetBuilder(df, label_col_name).dataset(shuffle=shuffle, batch_size=batch_size, seed=seed)
 
 def df_ls_to_tfds_ls(df_ls, label_col_name, shuffle=True, batch_size=32):
   return [df_to_tfds(df, label_col_name, shuffle, batch_size) for df in df_ls]
 
 
-def eval_metrics(model, tsdf_test, keras_metrics={}):
+def _fresh_metric(metric):
+  if isinstance(metric, str):
+    # the models here have one sigmoid output, where compile() would also
+    # resolve 'accuracy' to binary accuracy rather than exact match
+    if metric in ('accuracy', 'acc'):
+      return tf.keras.metrics.BinaryAccuracy(name=metric)
+    return tf.keras.metrics.get(metric)
+  return metric.__class__.from_config(metric.get_config())
+
+def _stream_metrics(predict_fn, tfds_test, metrics_ls):
+  # one pass, every batch updates each dict of streaming metrics with its own prediction
+  for x_test, y_test in tfds_test:
+    y_preds = predict_fn(x_test)
+    for metrics, y_pred in zip(metrics_ls, y_preds):
+      for metric in metrics.values():
+        metric.update_state(y_test, y_pred)
+
+  ret = []
+  for metrics in metrics_ls:
+    ret.append({metric_name: metric.result().numpy() for metric_name, metric in metrics.items()})
+    for metric in metrics.values():
+      metric.reset_state()
+  return ret
+
+def eval_metrics(model, tfds_test, keras_metrics={}):
   """Evaluate prediction metrics on tensorflow
-     test dataset  
+     test dataset
 
   Args:
+      model: keras model
+      tfds_test: batched (features, labels) dataset
+      keras_metrics: dict of metric name to keras metric instance,
+        the metrics are reset after reading the results
   """
+  predict_fn = tf.function(lambda x: [model(x, training=False)], reduce_retracing=True)
+  return _stream_metrics(predict_fn, tfds_test, [keras_metrics])[0]
 
-  ret = {}
-  for x_test, y_test in tfds_test:
-    y_pred = loaded_model.predict(x_test)
-    for metric_name, metric in metrics.items():
-      metric.update_state(y_test, y_pred)
 
-  for metric_name, metric in metrics.items():
-    ret[metric_name] = metric.result().numpy()
-    metric.reset_states()
+def ensemble_model(models, name='ensemble'):
+  """Fuse models with the same inputs into one model of stacked outputs.
 
-  return ret
+  Every member is called on the same input layers, one call of the
+  ensemble runs all members on a batch.
+
+  Returns:
+      keras model with outputs of shape (batch, n_models, *member output shape)
+  """
+  inputs = {
+    layer.name: tf.keras.Input(shape=layer.shape[1:], dtype=layer.dtype, name=layer.name)
+    for layer in tf.nest.flatten(models[0].inputs)
+  }
+  outputs = tf.keras.ops.stack([model(inputs, training=False) for model in models], axis=1)
+  return tf.keras.Model(inputs, outputs, name=name)
+
+def _member_weights(n_models, weights):
+  if weights is None:
+    return tf.fill([n_models], 1. / n_models)
+  weights = np.asarray(weights, dtype=np.float32)
+  if weights.shape != (n_models,) or (weights < 0).any() or weights.sum() <= 0:
+    raise ValueError(f'expected {n_models} non-negative member weights, got {weights}')
+  return tf.constant(weights / weights.sum())
+
+def aggregate_mean(y_preds, weights=None):
+  """Weighted average of stacked (batch, n_models, ...) predictions."""
+  w = _member_weights(y_preds.shape[1], weights)
+  w = tf.reshape(w, [1, -1] + [1] * (len(y_preds.shape) - 2))
+  return tf.reduce_sum(y_preds * tf.cast(w, y_preds.dtype), axis=1)
+
+def aggregate_vote(y_preds, weights=None, threshold=.5):
+  """Weighted vote share of stacked predictions.
+
+  Single output models vote positive above `threshold` and the share of
+  positive votes is returned, so thresholding it at .5 gives the majority.
+  Multi-class models vote for their argmax and the vote share per class
+  is returned.
+  """
+  w = _member_weights(y_preds.shape[1], weights)
+  if y_preds.shape[-1] == 1:
+    votes = tf.cast(y_preds > threshold, tf.float32)
+  else:
+    votes = tf.one_hot(tf.argmax(y_preds, axis=-1), y_preds.shape[-1])
+  w = tf.reshape(w, [1, -1] + [1] * (len(votes.shape) - 2))
+  return tf.reduce_sum(votes * w, axis=1)
+
+def aggregate_median(y_preds, weights=None):
+  """Median over members of stacked predictions, members are not weighted."""
+  if weights is not None:
+    raise ValueError('median aggregation does not take member weights')
+  n = y_preds.shape[1]
+  ordered = tf.sort(y_preds, axis=1)
+  return (ordered[:, (n - 1) // 2] + ordered[:, n // 2]) / 2
+
+ENSEMBLE_AGGREGATIONS = {
+  'mean': aggregate_mean,
+  'vote': aggregate_vote,
+  'median': aggregate_median,
+}
+
+def evaluate_ensemble(models, tfds_test, keras_metrics, aggregation='mean', weights=None, member_metrics=False):
+  """Evaluate an ensemble in one pass over the test set.
+
+  The members are fused with ensemble_model(), every batch is predicted
+  by all of them in one call and the streaming metrics are updated with
+  the aggregated prediction, so the cost is one dataset pass whatever
+  the number of models.
+
+  Args:
+      models: keras models with the same inputs
+      tfds_test: batched (features, labels) dataset
+      keras_metrics: dict of metric name to keras metric instance or name,
+        'accuracy' is taken as binary accuracy
+      aggregation[optional]: 'mean' (weighted), 'vote', 'median' or a
+        callable(y_preds, weights) over (batch, n_models, ...) predictions
+      weights[optional]: member weights, e.g. client sample counts
+      member_metrics[optional]: also evaluate every member on the same pass
+
+  Returns:
+      dict of ensemble metrics, and a list of member metric dicts when
+      member_metrics is set
+  """
+  if isinstance(aggregation, str):
+    if aggregation not in ENSEMBLE_AGGREGATIONS:
+      raise ValueError(f'unknown aggregation: {aggregation}, expected one of {list(ENSEMBLE_AGGREGATIONS)}')
+    aggregation = ENSEMBLE_AGGREGATIONS[aggregation]
+  fused = ensemble_model(models)
+  n_models = len(models)
+
+  metrics_ls = [{name: _fresh_metric(metric) for name, metric in keras_metrics.items()}]
+  if member_metrics:
+    metrics_ls += [{name: _fresh_metric(metric) for name, metric in keras_metrics.items()} for _ in models]
+
+  @tf.function(reduce_retracing=True)
+  def predict_fn(x):
+    y_preds = fused(x, training=False)
+    ret = [aggregation(y_preds, weights)]
+    if member_metrics:
+      ret += [y_preds[:, i] for i in range(n_models)]
+    return ret
+
+  ret = _stream_metrics(predict_fn, tfds_test, metrics_ls)
+  if member_metrics:
+    return ret[0], ret[1:]
+  return ret[0]
 
 
 class MetricsLogger(tf.keras.callbacks.Callback):
@@ -71,4 +271,28 @@ class MetricsLogger(tf.keras.callbacks.Callback):
       fo.flush()
 
   def _get_records(self):
-      return self._records
\ No newline at end of file
+      return self._records
+
+class FedProxCallback(tf.keras.callbacks.Callback):
+  """Proximal step toward the round's global weights after every batch.
+
+  Applies w <- w - lr * mu * (w - w_global) to the trainable weights,
+  i.e. the gradient of the FedProx term mu/2 * ||w - w_global||^2.
+  """
+  def __init__(self, global_weights, mu):
+    super().__init__()
+    self.global_weights = global_weights
+    self.mu = mu
+    self._anchors = None
+
+  def on_train_begin(self, logs=None):
+    self._anchors = [
+      (var, tf.constant(w, dtype=var.dtype))
+      for var, w in zip(self.model.weights, self.global_weights)
+      if var.trainable
+    ]
+
+  def on_train_batch_end(self, batch, logs=None):
+    step = float(tf.keras.backend.get_value(self.model.optimizer.learning_rate)) * self.mu
+    for var, anchor in self._anchors:
+      var.assign_sub(step * (var - anchor))
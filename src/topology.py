@@ -0,0 +1,139 @@
+import numpy as np
+from src.emulator import UnitProcess
+
+
+class Topology:
+  """Array-backed tree of emulated nodes, e.g. base server -> regional -> edge.
+
+  Node i has parent[i] (-1 for the root) and depth[i]. Children are kept
+  as an offsets + indices index like ClientPartition: the children of i
+  are indices[offsets[i]:offsets[i+1]], in node order. Node 0 is the
+  root and parents come before their children, so a pass over reversed
+  node order visits every subtree bottom-up.
+
+  Building a 100k node topology is a few NumPy calls, UnitProcess objects
+  are only created by build() when the tasks need them.
+  """
+  def __init__(self, parent, names=None):
+    self.parent = np.asarray(parent, dtype=np.int64)
+    n = len(self.parent)
+    if n == 0 or self.parent[0] != -1 or (self.parent[1:] < 0).any() or \
+        (self.parent[1:] >= np.arange(1, n)).any():
+      raise ValueError('parent must start with the root (-1) and list every parent before its children')
+    self.names = list(names) if names is not None else [str(i) for i in range(n)]
+    if len(self.names) != n:
+      raise ValueError(f'expected {n} names, got {len(self.names)}')
+    self._index = None
+
+    # one vectorized pass per tier until the depths stop changing
+    self.depth = np.zeros(n, dtype=np.int64)
+    while True:
+      depth = np.concatenate([[0], self.depth[self.parent[1:]] + 1])
+      if np.array_equal(depth, self.depth):
+        break
+      self.depth = depth
+
+    counts = np.bincount(self.parent[1:], minlength=n)
+    self.offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=self.offsets[1:])
+    self.indices = np.argsort(self.parent[1:], kind='stable') + 1
+
+  @classmethod
+  def from_fanout(cls, fanouts, tier_names=None):
+    """Balanced tree where every node of tier t has fanouts[t] children.
+
+    Args:
+        fanouts: children per node for each tier below the root,
+          e.g. [10, 1000] for 10 regional servers of 1000 edges each
+        tier_names[optional]: name prefix per tier including the root,
+          nodes are named '<prefix> [<index in tier>]'
+    """
+    if tier_names is None:
+      tier_names = ['BaseServer'] + [f'Tier{t + 1}' for t in range(len(fanouts))]
+    if len(tier_names) != len(fanouts) + 1:
+      raise ValueError('expected one tier name for the root and one per fanout')
+    parent = [np.array([-1])]
+    names = [tier_names[0]]
+    tier_start, tier_size = 0, 1
+    for t, fanout in enumerate(fanouts):
+      parent.append(np.repeat(np.arange(tier_start, tier_start + tier_size), fanout))
+      width = len(str(tier_size * fanout - 1))
+      names.extend(f'{tier_names[t + 1]} [{i:0{width}}]' for i in range(tier_size * fanout))
+      tier_start, tier_size = tier_start + tier_size, tier_size * fanout
+    return cls(np.concatenate(parent), names)
+
+  @classmethod
+  def from_tree(cls, root: UnitProcess):
+    """Topology of an existing UnitProcess tree, nodes in breadth-first order."""
+    nodes, parent = [root], [-1]
+    i = 0
+    while i < len(nodes):
+      for child in nodes[i].children:
+        nodes.append(child)
+        parent.append(i)
+      i += 1
+    return cls(parent, [node.name for node in nodes])
+
+  def __len__(self):
+    return len(self.parent)
+
+  def children(self, i):
+    return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+  @property
+  def num_child(self):
+    return np.diff(self.offsets)
+
+  def leaves(self):
+    return np.flatnonzero(self.num_child == 0)
+
+  def tier(self, depth):
+    return np.flatnonzero(self.depth == depth)
+
+  def ancestors(self, i):
+    """Node ids from i's parent up to the root."""
+    out = []
+    i = self.parent[i]
+    while i >= 0:
+      out.append(i)
+      i = self.parent[i]
+    return np.array(out, dtype=np.int64)
+
+  def index(self, name):
+    if self._index is None:
+      self._index = {name: i for i, name in enumerate(self.names)}
+    return self._index[name]
+
+  def subtree_sum(self, values):
+    """Per node sum of `values` over its subtree, e.g. aggregated request counts."""
+    total = np.array(values, dtype=np.float64 if np.asarray(values).dtype.kind == 'f' else np.int64)
+    for depth in range(self.depth.max(), 0, -1):
+      level = self.tier(depth)
+      np.add.at(total, self.parent[level], total[level])
+    return total
+
+  def build(self, cls=UnitProcess, setup=None):
+    """Create the node objects, in node order.
+
+    Args:
+        cls[optional]: node class
+        setup[optional]: callable(node, i) run on every new node, e.g. to
+          create its tasks and cache
+
+    Returns:
+        list of nodes indexed like the topology, nodes[0] is the root
+    """
+    nodes = [None] * len(self)
+    for i, (p, name) in enumerate(zip(self.parent.tolist(), self.names)):
+      parent = nodes[p] if p >= 0 else None
+      node = cls(name=name, parent=parent)
+      if parent is not None:
+        parent._append_child(child=node)
+      if setup is not None:
+        setup(node, i)
+      nodes[i] = node
+    return nodes
+
+  def __repr__(self):
+    tiers = np.bincount(self.depth)
+    return f'<{self.__class__.__name__}: {len(self)} nodes  tiers: {tiers.tolist()}>'
@@ -0,0 +1,217 @@
+import numpy as np
+
+
+def payload_nbytes(payload):
+  """Bytes a payload costs on the uplink.
+
+  Only the arrays are counted, `meta` (shapes, dtypes, codec name) is
+  structure the server already knows from the model.
+  """
+  return int(sum(a.nbytes for a in payload['arrays'].values()))
+
+def weights_nbytes(weights):
+  return int(sum(np.asarray(w).nbytes for w in weights))
+
+
+class UpdateCodec:
+  """Encodes a client's list of weight arrays for the uplink.
+
+  encode() returns a payload dict {'codec', 'arrays', 'meta'}, decode()
+  turns it back into a list of arrays of the original shapes and dtypes.
+  Codecs may keep per-client state (error feedback), so use one instance
+  per client. That state only advances on commit(), which the server
+  calls once the encoded update was accepted. Codecs with `uses_reference`
+  set encode the difference to the reference themselves.
+  """
+  name = None
+  uses_reference = False
+
+  def encode(self, weights, reference=None):
+    raise NotImplementedError
+
+  def decode(self, payload, reference=None):
+    raise NotImplementedError
+
+  def commit(self):
+    pass
+
+  def _meta(self, weights):
+    return {
+      'shapes': [np.shape(w) for w in weights],
+      'dtypes': [np.asarray(w).dtype for w in weights],
+    }
+
+
+class IdentityCodec(UpdateCodec):
+  name = 'identity'
+
+  def encode(self, weights, reference=None):
+    arrays = {str(i): np.asarray(w) for i, w in enumerate(weights)}
+    return {'codec': self.name, 'arrays': arrays, 'meta': self._meta(weights)}
+
+  def decode(self, payload, reference=None):
+    return [payload['arrays'][str(i)] for i in range(len(payload['meta']['shapes']))]
+
+
+class QuantizeCodec(UpdateCodec):
+  """Per-array affine quantization to 8 or 4 bits.
+
+  Every array is stored as uint8 codes plus a float32 (min, scale) pair,
+  4-bit codes are packed two per byte. With `stochastic=True` codes are
+  rounded randomly, which keeps the quantized update unbiased.
+  """
+  name = 'quantize'
+
+  def __init__(self, bits=8, stochastic=False, seed=None):
+    if bits not in (4, 8):
+      raise ValueError(f'unsupported quantization width: {bits}')
+    self.bits = bits
+    self.stochastic = stochastic
+    self.rng = np.random.default_rng(seed)
+
+  def encode(self, weights, reference=None):
+    levels = 2 ** self.bits - 1
+    arrays = {}
+    for i, w in enumerate(weights):
+      x = np.asarray(w, dtype=np.float32).ravel()
+      lo = float(x.min()) if x.size else 0.
+      hi = float(x.max()) if x.size else 0.
+      scale = (hi - lo) / levels if hi > lo else 1.
+      q = (x - lo) / scale
+      if self.stochastic:
+        q += self.rng.random(q.shape, dtype=np.float32)
+        np.floor(q, out=q)
+      else:
+        np.rint(q, out=q)
+      np.clip(q, 0, levels, out=q)
+      q = q.astype(np.uint8)
+      if self.bits == 4:
+        if q.size % 2:
+          q = np.append(q, np.uint8(0))
+        q = q[0::2] | (q[1::2] << 4)
+      arrays[f'{i}.q'] = q
+      arrays[f'{i}.range'] = np.array([lo, scale], dtype=np.float32)
+    return {'codec': self.name, 'arrays': arrays, 'meta': self._meta(weights)}
+
+  def decode(self, payload, reference=None):
+    out = []
+    arrays = payload['arrays']
+    for i, (shape, dtype) in enumerate(zip(payload['meta']['shapes'], payload['meta']['dtypes'])):
+      q = arrays[f'{i}.q']
+      if self.bits == 4:
+        q = np.stack([q & 0x0F, q >> 4], axis=1).ravel()
+      size = int(np.prod(shape))
+      lo, scale = arrays[f'{i}.range']
+      x = q[:size].astype(np.float32) * scale + lo
+      out.append(_cast(x.reshape(shape), dtype))
+    return out
+
+
+class TopKCodec(UpdateCodec):
+  """Top-k sparsification over all arrays with error feedback.
+
+  Only the `ratio` largest magnitude entries of the update
+  weights - reference are sent as (int32 index, float32 value) pairs and
+  decode adds them back onto the reference, so the entries left out keep
+  their global value. Both need the reference (global) weights. With
+  error feedback the entries left out are accumulated in a residual and
+  added to the next update, so nothing is lost, only delayed.
+  """
+  name = 'topk'
+  uses_reference = True
+
+  def __init__(self, ratio=0.01, error_feedback=True):
+    self.ratio = ratio
+    self.error_feedback = error_feedback
+    self._residual = None
+    self._pending = None
+
+  def encode(self, weights, reference=None):
+    if reference is None:
+      raise ValueError('top-k encoding needs the reference (global) weights')
+    meta = self._meta(weights)
+    flat = np.concatenate([np.subtract(w, r, dtype=np.float32).ravel() for w, r in zip(weights, reference)])
+    if self.error_feedback:
+      if self._residual is None or self._residual.shape != flat.shape:
+        self._residual = np.zeros_like(flat)
+      flat += self._residual
+
+    k = max(1, int(round(flat.size * self.ratio)))
+    if k < flat.size:
+      idx = np.argpartition(np.abs(flat), flat.size - k)[flat.size - k:]
+    else:
+      idx = np.arange(flat.size)
+    idx = np.sort(idx).astype(np.int32)
+    values = flat[idx]
+
+    if self.error_feedback:
+      flat[idx] = 0
+      self._pending = flat
+    return {
+      'codec': self.name,
+      'arrays': {'indices': idx, 'values': values},
+      'meta': meta,
+    }
+
+  def decode(self, payload, reference=None):
+    if reference is None:
+      raise ValueError('top-k decoding needs the reference (global) weights')
+    shapes, dtypes = payload['meta']['shapes'], payload['meta']['dtypes']
+    sizes = [int(np.prod(shape)) for shape in shapes]
+    flat = np.zeros(sum(sizes), dtype=np.float32)
+    flat[payload['arrays']['indices']] = payload['arrays']['values']
+    out, offset = [], 0
+    for r, shape, dtype, size in zip(reference, shapes, dtypes, sizes):
+      out.append(_cast(np.add(r, flat[offset:offset + size].reshape(shape), dtype=np.float32), dtype))
+      offset += size
+    return out
+
+  def commit(self):
+    if self._pending is not None:
+      self._residual, self._pending = self._pending, None
+
+
+class DeltaCodec(UpdateCodec):
+  """Encodes the difference to the last global weights.
+
+  The update w - reference is passed to the `inner` codec (sent as is
+  when None), decode adds the decoded delta back onto the reference.
+  Quantization is meant to be wrapped in it, codecs that use the
+  reference themselves (top-k) are handed the weights unchanged.
+  """
+  name = 'delta'
+  uses_reference = True
+
+  def __init__(self, inner=None):
+    self.inner = IdentityCodec() if inner is None else inner
+
+  def encode(self, weights, reference=None):
+    if reference is None:
+      raise ValueError('delta encoding needs the reference (global) weights')
+    if self.inner.uses_reference:
+      payload = self.inner.encode(weights, reference=reference)
+    else:
+      delta = [np.subtract(w, r, dtype=np.float32) for w, r in zip(weights, reference)]
+      payload = self.inner.encode(delta)
+      payload['meta'] = dict(payload['meta'], dtypes=[np.asarray(w).dtype for w in weights])
+    payload['codec'] = f'{self.name}+{payload["codec"]}'
+    return payload
+
+  def decode(self, payload, reference=None):
+    if reference is None:
+      raise ValueError('delta decoding needs the reference (global) weights')
+    if self.inner.uses_reference:
+      return self.inner.decode(payload, reference=reference)
+    dtypes = payload['meta']['dtypes']
+    inner_payload = dict(payload, meta=dict(payload['meta'], dtypes=[np.dtype(np.float32)] * len(dtypes)))
+    delta = self.inner.decode(inner_payload)
+    return [_cast(np.add(r, d, dtype=np.float32), dtype) for r, d, dtype in zip(reference, delta, dtypes)]
+
+  def commit(self):
+    self.inner.commit()
+
+
+def _cast(x, dtype):
+  if np.issubdtype(dtype, np.integer):
+    return np.rint(x).astype(dtype)
+  return x.astype(dtype, copy=False)
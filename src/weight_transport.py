@@ -0,0 +1,183 @@
+import numpy as np
+from pathlib import Path
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+_ALIGN = 64
+
+
+class WeightLayout:
+  """Offset table for a list of arrays packed into one byte buffer.
+
+  Every array starts on a 64 byte boundary so the views stay aligned.
+  The layout is small and picklable, it is what travels to the workers.
+  """
+  def __init__(self, shapes, dtypes):
+    self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+    self.dtypes = [np.dtype(dtype) for dtype in dtypes]
+    self.offsets = []
+    offset = 0
+    for shape, dtype in zip(self.shapes, self.dtypes):
+      offset = -(-offset // _ALIGN) * _ALIGN
+      self.offsets.append(offset)
+      offset += int(np.prod(shape)) * dtype.itemsize
+    self.nbytes = -(-offset // _ALIGN) * _ALIGN
+
+  @classmethod
+  def from_weights(cls, weights):
+    weights = [np.asarray(w) for w in weights]
+    return cls([w.shape for w in weights], [w.dtype for w in weights])
+
+  def __len__(self):
+    return len(self.shapes)
+
+  def __eq__(self, other):
+    return isinstance(other, WeightLayout) and self.shapes == other.shapes and self.dtypes == other.dtypes
+
+  def __repr__(self):
+    return f'<{self.__class__.__name__}: {len(self)} arrays  nbytes: {self.nbytes}>'
+
+
+class WeightBuffer:
+  """A list of arrays backed by one contiguous buffer.
+
+  The buffer is either private memory, a multiprocessing shared memory
+  block or a memory-mapped file. unpack() returns views, so workers that
+  attach through handle() read and write the weights without pickling or
+  per-array copies. The views are only valid until close().
+  """
+  def __init__(self, layout: WeightLayout, buf, handle=None, owner=None, attached=False):
+    self.layout = layout
+    self.buf = buf
+    self._handle = handle
+    self._owner = owner
+    self._attached = attached
+    self._views = [
+      np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+      for shape, dtype, offset in zip(layout.shapes, layout.dtypes, layout.offsets)
+    ]
+
+  @classmethod
+  def allocate(cls, layout, count=None):
+    if count == 0:
+      return []
+    return _split(cls, layout, np.zeros(_total(layout, count), dtype=np.uint8), count, {'backend': 'memory'})
+
+  @classmethod
+  def create_shared(cls, layout, count=None, name=None):
+    """Shared memory block holding `count` consecutive slots (one if None)."""
+    if count == 0:
+      return []
+    shm = shared_memory.SharedMemory(name=name, create=True, size=_total(layout, count))
+    handle = {'backend': 'shm', 'name': shm.name, 'layout': layout, 'offset': 0}
+    return _split(cls, layout, shm.buf, count, handle, owner=shm)
+
+  @classmethod
+  def create_memmap(cls, layout, path, count=None):
+    if count == 0:
+      return []
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    mm = np.memmap(path, dtype=np.uint8, mode='w+', shape=(_total(layout, count),))
+    handle = {'backend': 'mmap', 'path': str(path), 'layout': layout, 'offset': 0}
+    return _split(cls, layout, mm, count, handle, owner=mm)
+
+  @classmethod
+  def attach(cls, handle):
+    """Reopen a buffer from its handle, typically inside a worker process.
+
+    Every attach maps the block anew and close() (or leaving a with
+    block) unmaps it again, so long-lived workers hold no segments
+    between tasks.
+    """
+    layout = handle['layout']
+    backend = handle['backend']
+    if backend == 'shm':
+      shm = shared_memory.SharedMemory(name=handle['name'])
+      buf = shm.buf[handle['offset']:handle['offset'] + layout.nbytes]
+      return cls(layout, buf, handle=handle, owner=shm, attached=True)
+    if backend == 'mmap':
+      mm = np.memmap(handle['path'], dtype=np.uint8, mode='r+')
+      buf = mm[handle['offset']:handle['offset'] + layout.nbytes]
+      return cls(layout, buf, handle=handle, attached=True)
+    raise ValueError(f'cannot attach to a {backend} weight buffer')
+
+  def handle(self):
+    if self._handle is None or self._handle['backend'] == 'memory':
+      raise ValueError('private weight buffers have no handle, use create_shared or create_memmap')
+    return self._handle
+
+  def pack(self, weights):
+    for view, w in zip(self._views, weights):
+      np.copyto(view, w, casting='unsafe')
+    return self
+
+  def unpack(self):
+    return self._views
+
+  def __getitem__(self, index):
+    return self._views[index]
+
+  def __len__(self):
+    return len(self._views)
+
+  def close(self):
+    """Drop the views, and free the backing block if this buffer owns it.
+
+    Attached buffers only unmap the block, the creator unlinks it. With
+    slotted buffers the owning slot is the first one, close the others
+    before it (close_buffers() does that).
+    """
+    # cleared in place, lists handed out by unpack() must not keep the block mapped
+    self._views.clear()
+    self.buf = None
+    if isinstance(self._owner, shared_memory.SharedMemory):
+      self._owner.close()
+      if not self._attached:
+        self._owner.unlink()
+    self._owner = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+  def __repr__(self):
+    backend = 'memory' if self._handle is None else self._handle['backend']
+    return f'<{self.__class__.__name__}: {backend}  {self.layout}>'
+
+
+def _total(layout, count):
+  return layout.nbytes * (1 if count is None else count)
+
+def _split(cls, layout, buf, count, handle, owner=None):
+  if count is None:
+    return cls(layout, buf, handle=handle, owner=owner)
+  slots = []
+  for i in range(count):
+    offset = i * layout.nbytes
+    slot_handle = dict(handle, offset=offset)
+    slots.append(cls(layout, buf[offset:offset + layout.nbytes], handle=slot_handle))
+  # the first slot keeps the backing block alive and releases it on close()
+  slots[0]._owner = owner
+  return slots
+
+
+def close_buffers(buffers):
+  for buf in sorted(buffers, key=lambda b: b._owner is not None):
+    buf.close()
+
+@contextmanager
+def open_weights(weights):
+  """Accept either a list of arrays or a WeightBuffer handle.
+
+  A handle is attached for the with block only, the arrays are views
+  into the shared block and are cleared on exit, copy what has to
+  outlive it.
+  """
+  if not (isinstance(weights, dict) and 'layout' in weights):
+    yield weights
+    return
+  with WeightBuffer.attach(weights) as buf:
+    yield buf.unpack()
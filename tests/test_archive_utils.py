@@ -0,0 +1,44 @@
+import io
+import os
+import time
+import zipfile
+import tempfile
+import unittest
+from pathlib import Path
+from unittest import mock
+from src.archive_utils import unload_zip_from_io
+
+
+def _zip(members):
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, 'w', compression=zipfile.ZIP_DEFLATED) as zp:
+    for name, data in members.items():
+      zp.writestr(name, data)
+  buf.seek(0)
+  return buf
+
+
+class TestUnloadZip(unittest.TestCase):
+  def test_parallel_members_of_one_folder(self):
+    members = {f'ml-100k/sub/u{i}.data': bytes([i]) * (1000 + i) for i in range(32)}
+    makedirs = os.makedirs
+    def slow_makedirs(*args, **kwargs):
+      # widens the window between zipfile's exists check and makedirs
+      time.sleep(.01)
+      return makedirs(*args, **kwargs)
+    with tempfile.TemporaryDirectory() as folder, mock.patch('os.makedirs', slow_makedirs):
+      unload_zip_from_io(_zip(members), folder, workers=16)
+      for name, data in members.items():
+        self.assertEqual((Path(folder) / name).read_bytes(), data)
+
+  def test_selected_members_only(self):
+    members = {'ml-100k/u.data': b'1', 'ml-100k/u.user': b'2', 'ml-100k/u.item': b'3'}
+    with tempfile.TemporaryDirectory() as folder:
+      unload_zip_from_io(_zip(members), folder, members=['u.data', 'ml-100k/u.item'])
+      self.assertEqual(sorted(p.name for p in Path(folder, 'ml-100k').iterdir()), ['u.data', 'u.item'])
+      with self.assertRaises(ValueError):
+        unload_zip_from_io(_zip(members), folder, members=['u.missing'])
+
+
+if __name__ == '__main__':
+  unittest.main()
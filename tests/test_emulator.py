@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from src.emulator import UnitProcess, replay_trace
+
+
+def _tree(n_clients):
+  root = UnitProcess(name='root')
+  root.create_cache(1e6)
+  for i in range(n_clients):
+    root.spawn_child(f'client [{i}]').create_cache(1e4)
+  return root
+
+
+class TestReplayTrace(unittest.TestCase):
+  def test_counts_every_request(self):
+    root = _tree(2)
+    user_ids = np.array([0, 1, 2, 0])
+    stats = replay_trace(root, user_ids, np.array([5, 5, 6, 5]), np.array([0, 1, 1]))
+    self.assertEqual(stats['client [0]']['requests'], 2)
+    self.assertEqual(stats['client [1]']['requests'], 2)
+    self.assertEqual(stats['client [0]']['hits'], 1)
+
+  def test_array_assignment_out_of_range(self):
+    for assignment in (np.array([0, 2]), np.array([0, -1])):
+      with self.assertRaises(ValueError):
+        replay_trace(_tree(2), np.array([0, 1]), np.array([5, 6]), assignment)
+
+  def test_dict_assignment_unknown_user(self):
+    with self.assertRaises(KeyError):
+      replay_trace(_tree(2), np.array([0, 7]), np.array([5, 6]), {0: 0, 1: 1})
+
+
+if __name__ == '__main__':
+  unittest.main()